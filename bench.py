@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import audioop
+import os
+import random
+import tempfile
+import time
+
+from fakes import FakeBot, FakeChannel, FakeExtractor, FakeGuild, FakeMember, LocalAudioServer, NullTransport
+from init import (BroadcastTransport, PCMEngine, Prewarmable, Song, TrackIndex, VoiceState, YTDLError, YTDLSource,
+                  loop_monitor, metrics, numpy)
+
+# Drives many simulated guilds through play, skip and queue against the fakes
+# and prints the player's own latency metrics. Nothing touches Discord or
+# YouTube.
+#
+#   python bench.py --guilds 2000 --songs 5
+#   python bench.py --guilds 50 --ffmpeg      # real ffmpeg decoding a local stream
+#   python bench.py --pcm                     # per-frame cost of gain and crossfades
+#   python bench.py --broadcast --catalog 3   # every guild tuned into one shared channel
+
+
+async def session(guild_id: int, bot: FakeBot, transport: NullTransport, args, rng: random.Random, totals: dict):
+    await asyncio.sleep(rng.uniform(0, args.ramp))
+
+    guild = FakeGuild(guild_id)
+    text = FakeChannel(guild, guild_id * 10 + 1)
+    member = FakeMember(guild_id * 10 + 2)
+    if args.broadcast:
+        transport = BroadcastTransport('bench', transport)
+    state = VoiceState(bot, guild, transport=transport)
+    state.voice = await transport.connect(FakeChannel(guild, guild_id * 10 + 3))
+
+    queued = 0
+    try:
+        for _ in range(args.songs):
+            # A few songs are far more popular than the rest, like real traffic.
+            query = 'song {}'.format(int(rng.paretovariate(1.16)) % args.catalog)
+            try:
+                track = await YTDLSource.resolve(query, loop=bot.loop, guild_id=guild_id)
+            except YTDLError:
+                totals['failed'] += 1
+                continue
+
+            await state.songs.put(Song(track, member, text))
+            queued += 1
+            totals['queued'] += 1
+
+            await asyncio.sleep(rng.uniform(0, args.think))
+            if state.is_playing and rng.random() < args.skip:
+                state.skip()
+                totals['skipped'] += 1
+
+        deadline = time.monotonic() + args.duration * (queued + 1) / (args.speed or 1000) + 30
+        while state.voice.played < queued and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        totals['played'] += state.voice.played
+    finally:
+        await state.stop()
+
+
+def report(name: str, label: str, **labels):
+    def text(q):
+        value = metrics.quantile(name, q, **labels)
+        return '-' if value is None else '{:.0f} ms'.format(value * 1000) if value != float('inf') else 'inf'
+
+    histogram = metrics.histogram(name, **labels)
+    count = histogram.count if histogram else 0
+    print('  {:<22} p50 ≤ {:>8}   p95 ≤ {:>8}   p99 ≤ {:>8}   n={}'.format(
+        label, text(0.5), text(0.95), text(0.99), count))
+
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+    rng = random.Random(args.seed)
+
+    server = await LocalAudioServer().start() if args.ffmpeg else None
+    YTDLSource.extractor = FakeExtractor(server=server, latency=args.latency, duration=args.duration)
+    directory = tempfile.mkdtemp(prefix='nia-bench-')
+    YTDLSource.index = TrackIndex(os.path.join(directory, 'tracks.sqlite3'))
+
+    transport = NullTransport(ffmpeg=args.ffmpeg, speed=args.speed)
+    bot = FakeBot(loop)
+    lag = loop.create_task(loop_monitor.run())
+    totals = dict(queued=0, played=0, skipped=0, failed=0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(session(guild_id, bot, transport, args, rng, totals)
+                           for guild_id in range(1, args.guilds + 1)))
+    elapsed = time.perf_counter() - started
+
+    lag.cancel()
+    YTDLSource.index.close()
+    if server is not None:
+        server.close()
+
+    scheduler = YTDLSource.scheduler.stats()
+    print('{} guilds in {:.1f}s: {queued} queued, {played} played, {skipped} skipped, {failed} failed'.format(
+        args.guilds, elapsed, **totals))
+    print('  {:.1f} songs/s, {} extractor calls, {} cache hits, {} lookups rejected, {} ffmpeg left running'.format(
+        totals['played'] / elapsed, YTDLSource.extractor.calls, YTDLSource.cache.hits,
+        scheduler['rejected'], Prewarmable.processes))
+    print('  {} sources opened for {} songs played'.format(transport.opened, totals['played']))
+    report('nia_extraction_seconds', 'lookup (search)', stage='search')
+    report('nia_extraction_seconds', 'lookup (process)', stage='process')
+    report('nia_queue_to_audio_seconds', 'queue to audio')
+    report('nia_track_gap_seconds', 'gap between songs')
+    report('nia_event_loop_lag_seconds', 'event loop lag')
+
+
+def pcm(args):
+    # What a voice client pays per 20 ms frame, which has to stay far below
+    # 20 ms for every guild sharing the process.
+    size = PCMEngine.FRAME_SIZE
+    frames = [os.urandom(size) for _ in range(PCMEngine.BATCH * 200)]
+    batches = [b''.join(frames[i:i + PCMEngine.BATCH]) for i in range(0, len(frames), PCMEngine.BATCH)]
+    rounds = 20
+
+    def measure(label: str, work, count: int):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            work()
+        per_frame = (time.perf_counter() - started) / (rounds * count)
+        print('  {:<34} {:>6.1f} µs/frame'.format(label, per_frame * 1e6))
+
+    print('PCM engine, batches of {} frames, {}'.format(
+        PCMEngine.BATCH, 'NumPy ' + numpy.__version__ if numpy is not None else 'no NumPy (audioop)'))
+    measure('gain, audioop per frame', lambda: [audioop.mul(frame, 2, 0.7) for frame in frames], len(frames))
+    measure('gain, engine', lambda: [PCMEngine.gain(batch, 0.7) for batch in batches], len(frames))
+    measure('crossfade, engine', lambda: [PCMEngine.mix(batch, batch, 0.7, 0.5, 0.2, 0.3) for batch in batches],
+            len(frames))
+    measure('loudness, engine', lambda: [PCMEngine.power(batch) for batch in batches], len(frames))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the player offline.')
+    parser.add_argument('--guilds', type=int, default=1000)
+    parser.add_argument('--songs', type=int, default=5, help='songs queued per guild')
+    parser.add_argument('--catalog', type=int, default=5000, help='distinct songs to pick from')
+    parser.add_argument('--duration', type=int, default=10, help='length of every track in seconds')
+    parser.add_argument('--speed', type=float, default=10,
+                        help='playback speed; 0 reads frames as fast as possible')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds each fake extraction takes')
+    parser.add_argument('--ramp', type=float, default=10, help='guilds start over this many seconds')
+    parser.add_argument('--think', type=float, default=1, help='longest pause between commands')
+    parser.add_argument('--skip', type=float, default=0.2, help='chance of a skip after each song is queued')
+    parser.add_argument('--ffmpeg', action='store_true', help='decode a local stream with ffmpeg')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pcm', action='store_true', help='only time the PCM engine')
+    parser.add_argument('--broadcast', action='store_true', help='tune every guild into one shared channel')
+    args = parser.parse_args()
+
+    if args.pcm:
+        return pcm(args)
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+import asyncio
+import hashlib
+import math
+import struct
+import threading
+import time
+import urllib.parse
+
+import discord
+
+from init import DiscordTransport, Extractor, ExtractionCache, Prewarmable, Track, VoiceTransport
+
+# Stand-ins for Discord and YouTube so the player can be driven offline.
+# Nothing in here talks to the network except LocalAudioServer, which only
+# listens on localhost.
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+# One 20 ms frame of 16-bit stereo PCM, the unit voice clients read in.
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+FRAME_LENGTH = discord.opus.Encoder.FRAME_LENGTH / 1000
+
+
+class LocalAudioServer:
+    # Serves a sine tone of any length as a WAV file, for exercising the
+    # real ffmpeg path without YouTube:
+    #   GET /<id>.wav?seconds=<n>
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, frequency: int = 440):
+        self.host = host
+        self.port = port
+        self.requests = 0
+        # One second of tone, repeated for as long as the track lasts.
+        self._second = b''.join(
+            struct.pack('<hh', sample, sample) for sample in (
+                int(8000 * math.sin(2 * math.pi * frequency * i / SAMPLE_RATE)) for i in range(SAMPLE_RATE)))
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+
+    def url(self, track_id: str, seconds: int):
+        return 'http://{}:{}/{}.wav?seconds={}'.format(self.host, self.port, track_id, seconds)
+
+    @staticmethod
+    def _header(size: int):
+        return (b'RIFF' + struct.pack('<I', 36 + size) + b'WAVE'
+                + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, CHANNELS, SAMPLE_RATE,
+                                        SAMPLE_RATE * CHANNELS * 2, CHANNELS * 2, 16)
+                + b'data' + struct.pack('<I', size))
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            path = request.split(b' ', 2)[1].decode()
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(path).query)
+            seconds = int(query.get('seconds', ['180'])[0])
+            self.requests += 1
+
+            size = seconds * len(self._second)
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: audio/wav\r\n'
+                         b'Content-Length: ' + str(44 + size).encode() + b'\r\n\r\n'
+                         + self._header(size))
+            for _ in range(seconds):
+                writer.write(self._second)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, IndexError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+class FakeExtractor(Extractor):
+    # Answers like youtube_dl would, after `latency` seconds. The same query
+    # always lands on the same video, so the caches behave as they would
+    # with real traffic.
+    def __init__(self, *, server: LocalAudioServer = None, latency: float = 0.05, duration: int = 180):
+        self.server = server
+        self.latency = latency
+        self.duration = duration
+        self.calls = 0
+
+    @staticmethod
+    def video_id(text: str):
+        return hashlib.sha1(text.encode()).hexdigest()[:11]
+
+    def _entry(self, video_id: str):
+        return {
+            '_type': 'video',
+            'id': video_id,
+            'title': 'Fake track {}'.format(video_id),
+            'webpage_url': 'https://fake.invalid/watch?v=' + video_id,
+            'uploader': 'Nobody',
+            'uploader_url': 'https://fake.invalid/nobody',
+            'duration': self.duration,
+            'view_count': 0,
+        }
+
+    def _wait(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def search(self, query: str):
+        self._wait()
+        return self._entry(self.video_id(ExtractionCache.normalize(query)))
+
+    def process(self, info: dict):
+        self._wait()
+        url = info.get('webpage_url') or info['url']
+        video_id = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get('v', [self.video_id(url)])[0]
+
+        info = self._entry(video_id)
+        if self.server is not None:
+            info['url'] = self.server.url(video_id, self.duration)
+        else:
+            # Never opened; NullTransport plays silence unless it runs ffmpeg.
+            info['url'] = 'http://127.0.0.1:9/{}.wav'.format(video_id)
+        info['acodec'] = 'pcm_s16le'
+        return info
+
+    def playlist(self, url: str):
+        self._wait()
+        count = int(urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get('count', ['25'])[0])
+        return {
+            '_type': 'playlist',
+            'entries': ({'id': self.video_id('{}#{}'.format(url, i)), 'title': 'Fake track {}'.format(i),
+                         'url': 'https://fake.invalid/watch?v=' + self.video_id('{}#{}'.format(url, i)),
+                         'duration': self.duration}
+                        for i in range(count)),
+        }
+
+
+class SilentSource(Prewarmable, discord.AudioSource):
+    # A track's worth of silence, without ffmpeg.
+    spawns_process = False
+
+    def __init__(self, track: Track, *, volume: float = 0.5, start: float = 0):
+        self.track = track
+        self.volume = volume
+        self._frames = max(int((track.duration - start) / FRAME_LENGTH), 1)
+        self._setup_prewarm()
+
+    def __str__(self):
+        return str(self.track)
+
+    def _read_frame(self):
+        if self._frames <= 0:
+            return b''
+        self._frames -= 1
+        return bytes(FRAME_SIZE)
+
+    def read(self):
+        if self._prewarmed:
+            return self._prewarmed.popleft()
+        return self._read_frame()
+
+
+class NullVoiceClient:
+    # Enough of discord.VoiceClient for VoiceState. Frames are read from the
+    # source on a thread like discord's AudioPlayer does and then dropped.
+    # `speed` scales the 20 ms pacing; 0 reads as fast as the source allows.
+    def __init__(self, channel, *, speed: float = 1.0):
+        self.channel = channel
+        self.speed = speed
+        self.source = None
+        self.frames = 0
+        self.played = 0
+        self._player = None
+        self._stopped = threading.Event()
+        self._resumed = threading.Event()
+
+    def play(self, source: discord.AudioSource, *, after=None):
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+
+        self.source = source
+        self._stopped = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._player = threading.Thread(target=self._run, args=(source, after), daemon=True)
+        self._player.start()
+
+    def _run(self, source: discord.AudioSource, after):
+        error = None
+        interval = FRAME_LENGTH / self.speed if self.speed else 0
+        next_frame = time.perf_counter()
+        try:
+            while not self._stopped.is_set():
+                if not self._resumed.is_set():
+                    self._resumed.wait()
+                    next_frame = time.perf_counter()
+                    continue
+
+                if not source.read():
+                    break
+                self.frames += 1
+
+                if interval:
+                    next_frame += interval
+                    time.sleep(max(0, next_frame - time.perf_counter()))
+        except Exception as e:
+            error = e
+        finally:
+            self._stopped.set()
+            source.cleanup()
+            self.played += 1
+            if after is not None:
+                after(error)
+
+    def is_playing(self):
+        return self._player is not None and not self._stopped.is_set() and self._resumed.is_set()
+
+    def is_paused(self):
+        return self._player is not None and not self._stopped.is_set() and not self._resumed.is_set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._resumed.set()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+
+
+class NullTransport(VoiceTransport):
+    # Voice goes nowhere. With `ffmpeg` the real sources are opened, so
+    # decoding cost is included; otherwise tracks are played as silence.
+    def __init__(self, *, ffmpeg: bool = False, speed: float = 1.0):
+        self.ffmpeg = ffmpeg
+        self.speed = speed
+        self.clients = []
+        self.opened = 0
+
+    async def connect(self, channel):
+        client = NullVoiceClient(channel, speed=self.speed)
+        self.clients.append(client)
+        return client
+
+    def open(self, track: Track, *, volume: float, start: float = 0, path: str = None, opus: bool = False):
+        self.opened += 1
+        if self.ffmpeg:
+            return DiscordTransport().open(track, volume=volume, start=start, path=path, opus=opus)
+        return SilentSource(track, volume=volume, start=start)
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = 'Guild {}'.format(guild_id)
+
+
+class FakeChannel:
+    # Text or voice; messages sent to it are counted and dropped.
+    def __init__(self, guild: FakeGuild, channel_id: int):
+        self.guild = guild
+        self.id = channel_id
+        self.sent = 0
+
+    async def send(self, content: str = None, **kwargs):
+        self.sent += 1
+
+
+class FakeMember:
+    def __init__(self, member_id: int):
+        self.id = member_id
+        self.mention = '<@{}>'.format(member_id)
+        self.name = 'Member {}'.format(member_id)
+
+
+class FakeBot:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
@@ -1,9 +1,30 @@
+import array
 import asyncio
+import audioop
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import datetime
 import functools
+import inspect
 import itertools
+import json
 import math
 import os
+import platform
 import random
+import re
+import shutil
+import socket
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
 import discord
 import youtube_dl
 from async_timeout import timeout
@@ -12,6 +33,11 @@ from youtube_dl.utils import PostProcessingError
 import pprint
 import speedtest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Silence useless bug reports messages
 youtube_dl.utils.bug_reports_message = lambda: ''
 
@@ -24,7 +50,1439 @@ class YTDLError(Exception):
     pass
 
 
-class YTDLSource(discord.PCMVolumeTransformer):
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float):
+        # Upper bound of the bucket the quantile falls in.
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    HELP = {
+        'nia_extraction_seconds': 'Time spent waiting for youtube_dl, by extraction stage.',
+        'nia_queue_to_audio_seconds': 'Time from a song being able to play to its first audio.',
+        'nia_track_gap_seconds': 'Silence between two consecutive songs.',
+        'nia_event_loop_lag_seconds': 'How late the event loop ran a scheduled wakeup.',
+    }
+
+    def __init__(self):
+        self._histograms = collections.defaultdict(dict)
+        self._counters = collections.defaultdict(dict)
+        self._gauges = {}
+
+    @staticmethod
+    def _labels(labels: dict):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name: str, value: float, **labels):
+        family = self._histograms[name]
+        key = self._labels(labels)
+        histogram = family.get(key)
+        if histogram is None:
+            histogram = family[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        family = self._counters[name]
+        key = self._labels(labels)
+        family[key] = family.get(key, 0) + value
+
+    def gauge(self, name: str, help: str, read):
+        # `read` returns a number, or a {labels dict items tuple: number} map.
+        self._gauges[name] = (help, read)
+
+    def histogram(self, name: str, **labels):
+        return self._histograms.get(name, {}).get(self._labels(labels))
+
+    def quantile(self, name: str, q: float, **labels):
+        histogram = self.histogram(name, **labels)
+        return histogram.quantile(q) if histogram else None
+
+    @staticmethod
+    def _format(name: str, labels, value):
+        if labels:
+            name += '{' + ','.join('{}="{}"'.format(key, val) for key, val in labels) + '}'
+        return '{} {}'.format(name, value)
+
+    def render(self):
+        lines = []
+        for name, family in self._histograms.items():
+            lines.append('# HELP {} {}'.format(name, self.HELP.get(name, name)))
+            lines.append('# TYPE {} histogram'.format(name))
+            for labels, histogram in family.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(self._format(name + '_bucket', labels + (('le', str(bound)),), cumulative))
+                lines.append(self._format(name + '_sum', labels, histogram.sum))
+                lines.append(self._format(name + '_count', labels, histogram.count))
+
+        for name, family in self._counters.items():
+            lines.append('# HELP {} {}'.format(name, self.HELP.get(name, name)))
+            lines.append('# TYPE {} counter'.format(name))
+            for labels, value in family.items():
+                lines.append(self._format(name, labels, value))
+
+        for name, (help, read) in self._gauges.items():
+            try:
+                value = read()
+            except Exception as e:
+                print("[ERROR] COULD NOT READ METRIC {}: {}".format(name, e))
+                continue
+
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} gauge'.format(name))
+            if isinstance(value, dict):
+                for labels, val in value.items():
+                    lines.append(self._format(name, labels, val))
+            else:
+                lines.append(self._format(name, (), value))
+
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host: str, port: int):
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Any request gets the exposition; this is only meant for a local scraper.
+        try:
+            async with timeout(5):
+                await reader.readuntil(b'\r\n\r\n')
+            body = self.render().encode()
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+metrics = Metrics()
+
+
+class LagMonitor:
+    INTERVAL = 0.5
+    STACK_LIMIT = 12
+    # Audit events that block the calling thread. Seen from a coroutine on
+    # the loop thread, each one stalls playback for every guild.
+    BLOCKING_EVENTS = {
+        'open', 'os.remove', 'os.rename', 'os.listdir', 'os.scandir', 'shutil.rmtree',
+        'subprocess.Popen', 'socket.connect', 'socket.getaddrinfo', 'sqlite3.connect',
+    }
+    # Debug mode has asyncio capture a traceback for every future and handle,
+    # which reads source lines through linecache, and asyncio connects its
+    # own non-blocking sockets. Events raised under these modules aren't ours.
+    IGNORED_MODULES = {'asyncio', 'linecache', 'tokenize', 'traceback'}
+
+    def __init__(self):
+        self.lag = 0.0
+        self.stalls = 0
+        self._loop = None
+        self._thread_id = None
+        self._ping = None
+        self._watchdog = None
+        self._reported = set()
+        self._auditing = threading.local()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self._loop = loop
+        self._thread_id = threading.get_ident()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.INTERVAL)
+            self.lag = max(loop.time() - start - self.INTERVAL, 0.0)
+            metrics.observe('nia_event_loop_lag_seconds', self.lag)
+
+    def watch(self, threshold: float):
+        # The watchdog lives on its own thread so it can look at the loop
+        # thread's stack while the loop is still stuck.
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(
+                target=self._watch, args=(threshold,), name='nia-watchdog', daemon=True)
+            self._watchdog.start()
+
+    def _pong(self):
+        self._ping = None
+
+    def _watch(self, threshold: float):
+        # Keep one callback queued on the loop; if it hasn't run within
+        # `threshold`, whatever is on the loop thread right now is the culprit.
+        reported = False
+        while True:
+            time.sleep(max(threshold / 4, 0.005))
+            if self._loop is None or self._loop.is_closed():
+                continue
+
+            if self._ping is None:
+                reported = False
+                self._ping = time.monotonic()
+                self._loop.call_soon_threadsafe(self._pong)
+                continue
+
+            late = time.monotonic() - self._ping
+            if late < threshold or reported:
+                continue
+
+            reported = True
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+
+            self.stalls += 1
+            metrics.inc('nia_event_loop_stalls_total')
+            print("[WARN] EVENT LOOP BLOCKED FOR OVER {:.0f} MS IN {}\n{}".format(
+                late * 1000, self.describe(frame), ''.join(self.format_stack(frame))), end='')
+
+    def debug(self, loop: asyncio.BaseEventLoop, threshold: float):
+        # asyncio reports slow callbacks itself in debug mode; the audit hook
+        # additionally names the blocking call. Audit hooks can't be removed,
+        # so this stays on until the process exits.
+        loop.set_debug(True)
+        loop.slow_callback_duration = threshold
+        sys.addaudithook(self._audit)
+
+    def _audit(self, event: str, args):
+        if event not in self.BLOCKING_EVENTS or threading.get_ident() != self._thread_id:
+            return
+        if getattr(self._auditing, 'active', False):
+            return
+
+        self._auditing.active = True
+        try:
+            frame = sys._getframe(1)
+            caller = self._coroutine_frame(frame)
+            if caller is None or self._ignored(frame, caller):
+                return
+
+            site = (event, caller.f_code.co_filename, caller.f_lineno)
+            if site in self._reported:
+                return
+            self._reported.add(site)
+
+            print("[WARN] BLOCKING CALL {} FROM COROUTINE {} IN {}\n{}".format(
+                event, caller.f_code.co_name, self.describe(frame),
+                ''.join(self.format_stack(frame, lookup_lines=False))), end='')
+        finally:
+            self._auditing.active = False
+
+    @classmethod
+    def _ignored(cls, frame, caller):
+        while frame is not None:
+            module = frame.f_globals.get('__name__', '')
+            if module.partition('.')[0] in cls.IGNORED_MODULES:
+                return True
+            if frame is caller:
+                return False
+            frame = frame.f_back
+        return False
+
+    @staticmethod
+    def _coroutine_frame(frame):
+        while frame is not None:
+            if frame.f_code.co_flags & (inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR):
+                return frame
+            frame = frame.f_back
+        return None
+
+    @classmethod
+    def format_stack(cls, frame, lookup_lines=True):
+        stack = traceback.StackSummary.extract(
+            traceback.walk_stack(frame), limit=cls.STACK_LIMIT, lookup_lines=lookup_lines)
+        stack.reverse()
+        return stack.format()
+
+    @staticmethod
+    def describe(frame):
+        # Work out which command or player the frame belongs to from the
+        # locals of the coroutines on the stack.
+        while frame is not None:
+            local = frame.f_locals
+            ctx = local.get('ctx')
+            if isinstance(ctx, commands.Context):
+                return 'COMMAND {} (GUILD {})'.format(
+                    ctx.command.qualified_name if ctx.command else '?',
+                    ctx.guild.id if ctx.guild else 'DM')
+
+            owner = local.get('self')
+            if isinstance(owner, VoiceState):
+                return '{} (GUILD {})'.format(frame.f_code.co_name, owner.guild.id)
+            frame = frame.f_back
+        return 'UNKNOWN CALLER'
+
+
+loop_monitor = LagMonitor()
+
+
+class ExtractionCache:
+    # Signed stream URLs stop working at their `expire` timestamp, so entries
+    # are dropped a little before that to leave time for ffmpeg to connect.
+    EXPIRY_MARGIN = 5 * 60
+
+    def __init__(self, max_entries: int = 512, ttl: float = 3 * 60 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(query: str):
+        query = query.strip()
+        if urllib.parse.urlparse(query).scheme in ('http', 'https'):
+            return query
+        return ' '.join(query.lower().split())
+
+    @staticmethod
+    def stream_expiry(url: str):
+        if not url:
+            return None
+
+        parsed = urllib.parse.urlparse(url)
+        values = urllib.parse.parse_qs(parsed.query).get('expire')
+        if values and values[0].isdigit():
+            return int(values[0])
+
+        match = re.search(r'/expire/(\d+)', parsed.path)
+        if match:
+            return int(match.group(1))
+
+        return None
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires, track = entry
+        if expires <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return track
+
+    def put(self, keys, track):
+        # Only tracks with a stream; one that plays from the audio cache has
+        # to be looked up again once its file is gone.
+        if not track.resolved:
+            return
+
+        expires = time.time() + self.ttl
+        if track.stream_expires is not None:
+            expires = min(expires, track.stream_expires - self.EXPIRY_MARGIN)
+
+        if expires <= time.time():
+            return
+
+        for key in keys:
+            if not key:
+                continue
+            self._entries[key] = (expires, track)
+            self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    async def run(self, key, factory):
+        # The call runs as its own task, so a caller that is cancelled only
+        # stops waiting; everyone else still gets the result.
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.get_event_loop().create_task(factory())
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+        return await asyncio.shield(task)
+
+    def _done(self, key, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the exception as retrieved in case nobody was waiting any more.
+        if not task.cancelled():
+            task.exception()
+
+
+class ExtractionScheduler:
+    def __init__(self, workers: int = 4, *, max_in_flight: int = None,
+                 max_backlog: int = 64, max_guild_backlog: int = 16):
+        self.workers = workers
+        self.max_in_flight = max_in_flight or workers
+        self.max_backlog = max_backlog
+        self.max_guild_backlog = max_guild_backlog
+
+        self._executor = None
+        self._queues = collections.OrderedDict()
+        self._backlog = 0
+        self._in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='nia-extract')
+        return self._executor
+
+    @property
+    def backlog(self):
+        return self._backlog
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def depth(self, guild_id=None):
+        queue = self._queues.get(guild_id)
+        return len(queue) if queue else 0
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'in_flight': self._in_flight,
+            'backlog': self._backlog,
+            'guilds_waiting': len(self._queues),
+            'completed': self.completed,
+            'rejected': self.rejected,
+        }
+
+    async def run(self, guild_id, func):
+        queue = self._queues.get(guild_id)
+        if self._backlog >= self.max_backlog or (queue and len(queue) >= self.max_guild_backlog):
+            self.rejected += 1
+            raise YTDLError(
+                'I\'m swamped with requests right now, give me a moment and try again')
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if queue is None:
+            queue = self._queues[guild_id] = collections.deque()
+        queue.append((func, future))
+        self._backlog += 1
+
+        self._dispatch(loop)
+        return await future
+
+    def _dispatch(self, loop: asyncio.BaseEventLoop):
+        while self._in_flight < self.max_in_flight and self._queues:
+            # Serve guilds round-robin: take one job from the guild at the
+            # front, then send that guild to the back of the line.
+            guild_id, queue = self._queues.popitem(last=False)
+            func, future = queue.popleft()
+            self._backlog -= 1
+            if queue:
+                self._queues[guild_id] = queue
+
+            if future.cancelled():
+                continue
+
+            self._in_flight += 1
+            job = loop.run_in_executor(self.executor, func)
+            job.add_done_callback(functools.partial(self._finished, loop, future))
+
+    def _finished(self, loop: asyncio.BaseEventLoop, future: asyncio.Future, job: asyncio.Future):
+        self._in_flight -= 1
+        self.completed += 1
+
+        if not future.cancelled():
+            if job.cancelled():
+                future.cancel()
+            elif job.exception() is not None:
+                future.set_exception(job.exception())
+            else:
+                future.set_result(job.result())
+
+        self._dispatch(loop)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class Track:
+    # Only what the embeds and the queue listing render, plus the stream to
+    # play. Playlist entries start out without a stream until resolved.
+    __slots__ = ('id', 'title', 'url', 'uploader', 'uploader_url', 'thumbnail',
+                 'duration', 'views', 'tags', 'stream_url', 'codec', 'loudness', 'stream_expires')
+
+    def __init__(self, *, id: str = None, title: str = None, url: str = None, uploader: str = None,
+                 uploader_url: str = None, thumbnail: str = None, duration: int = 0,
+                 views: int = None, tags: list = None, stream_url: str = None, codec: str = None,
+                 loudness: float = None):
+        self.id = id
+        self.title = title
+        self.url = url
+        self.uploader = uploader
+        self.uploader_url = uploader_url
+        self.thumbnail = thumbnail
+        self.duration = duration
+        self.views = views
+        # Only kept for the local search index.
+        self.tags = tags
+        self.stream_url = stream_url
+        self.codec = codec
+        # Average level in dBFS, measured the first time the track plays.
+        self.loudness = loudness
+        self.stream_expires = ExtractionCache.stream_expiry(stream_url)
+
+    def __str__(self):
+        if self.uploader is None:
+            return '**{0.title}**'.format(self)
+        return '**{0.title}** by **{0.uploader}**'.format(self)
+
+    @classmethod
+    def from_info(cls, info: dict):
+        return cls(id=info.get('id'),
+                   title=info.get('title'),
+                   url=info.get('webpage_url'),
+                   uploader=info.get('uploader'),
+                   uploader_url=info.get('uploader_url'),
+                   thumbnail=info.get('thumbnail'),
+                   duration=int(info.get('duration') or 0),
+                   views=info.get('view_count'),
+                   tags=(info.get('tags') or [])[:SearchIndex.MAX_TAGS] or None,
+                   stream_url=info.get('url'),
+                   codec=info.get('acodec'))
+
+    @classmethod
+    def from_entry(cls, entry: dict):
+        url = entry.get('webpage_url') or entry.get('url')
+        # Flat YouTube entries only carry the video id.
+        if not urllib.parse.urlparse(url).scheme and entry.get('ie_key') == 'Youtube':
+            url = 'https://www.youtube.com/watch?v=' + url
+
+        return cls(id=entry.get('id'),
+                   title=entry.get('title') or url,
+                   url=url,
+                   duration=int(entry.get('duration') or 0))
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'stream_expires'}
+
+    @property
+    def resolved(self):
+        return self.stream_url is not None
+
+    @property
+    def stale(self):
+        return (self.stream_expires is not None
+                and self.stream_expires - time.time() < ExtractionCache.EXPIRY_MARGIN)
+
+    @property
+    def duration_text(self):
+        return YTDLSource.parse_duration(self.duration)
+
+
+class TrackIndex:
+    # Writes are collected on the event loop and handed to the index thread
+    # in one transaction every FLUSH_DELAY seconds.
+    FLUSH_DELAY = 5
+    MAX_AGE = 30 * 24 * 60 * 60
+    PRUNE_EVERY = 60 * 60
+
+    def __init__(self, path: str, *, ttl: float = 3 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+        self._db = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='nia-index')
+        self._pending = {}
+        self._flush_handle = None
+        self._last_prune = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        # Opened on first use; nothing is read up front.
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS tracks ('
+                       'key TEXT PRIMARY KEY, track TEXT NOT NULL, '
+                       'stream_expires REAL NOT NULL, updated REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS tracks_updated ON tracks (updated)')
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _read(self, key: str):
+        return self._connect().execute(
+            'SELECT key, track, stream_expires, updated FROM tracks WHERE key = ?', (key,)).fetchone()
+
+    def _write(self, rows):
+        db = self._connect()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?)', rows)
+            now = time.time()
+            if now - self._last_prune > self.PRUNE_EVERY:
+                db.execute('DELETE FROM tracks WHERE updated < ?', (now - self.MAX_AGE,))
+                self._last_prune = now
+
+    def _read_tracks(self):
+        # Every `url:` key, i.e. each video once. A connection of its own, so
+        # lookups on the index thread don't queue behind the whole scan.
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            return [Track(**json.loads(data)) for data, in db.execute(
+                "SELECT track FROM tracks WHERE key >= 'url:' AND key < 'url;'")]
+        finally:
+            db.close()
+
+    async def tracks(self, *, loop: asyncio.BaseEventLoop = None):
+        loop = loop or asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(None, self._read_tracks)
+        except (sqlite3.Error, ValueError, TypeError) as e:
+            print("[ERROR] COULD NOT READ THE TRACK INDEX: {}".format(e))
+            return []
+
+    async def get(self, key: str, *, loop: asyncio.BaseEventLoop = None):
+        loop = loop or asyncio.get_event_loop()
+
+        row = self._pending.get(key)
+        if row is None:
+            try:
+                row = await loop.run_in_executor(self._executor, self._read, key)
+            except sqlite3.Error as e:
+                print("[ERROR] COULD NOT READ THE TRACK INDEX: {}".format(e))
+                return None
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        _, data, stream_expires, _ = row
+        track = Track(**json.loads(data))
+        if stream_expires - time.time() < ExtractionCache.EXPIRY_MARGIN:
+            # The metadata is still good, but the stream has to be looked up again.
+            track.stream_url = None
+            track.stream_expires = None
+        return track
+
+    def put(self, keys, track: Track):
+        now = time.time()
+        expires = now + self.ttl
+        if track.stream_expires is not None:
+            expires = min(expires, track.stream_expires)
+
+        data = json.dumps(track.to_dict())
+        for key in keys:
+            if key:
+                self._pending[key] = (key, data, expires, now)
+
+        if self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(self.FLUSH_DELAY, self._flush, loop)
+
+    def _flush(self, loop: asyncio.BaseEventLoop):
+        self._flush_handle = None
+        rows = list(self._pending.values())
+        self._pending.clear()
+        if rows:
+            # The index thread runs jobs in order, so reads queued after this
+            # write will see it.
+            job = loop.run_in_executor(self._executor, self._write, rows)
+            job.add_done_callback(self._flushed)
+
+    @staticmethod
+    def _flushed(job: asyncio.Future):
+        if not job.cancelled() and job.exception() is not None:
+            print("[ERROR] COULD NOT WRITE THE TRACK INDEX: {}".format(job.exception()))
+
+    def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        rows = list(self._pending.values())
+        self._pending.clear()
+        if rows:
+            self._executor.submit(self._write, rows).result()
+        self._executor.shutdown(wait=True)
+
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class SearchIndex:
+    # Titles, uploaders and tags of every track resolved so far. Tracks are
+    # found by their words, and misspelt words through a trigram index over
+    # the words seen so far. A search answered here needs no extractor call,
+    # which covers most repeats: the same song asked for in other words.
+    MAX_TAGS = 10
+    # Words that say nothing about which song is meant.
+    NOISE = frozenset(('official', 'video', 'music', 'audio', 'lyric', 'lyrics', 'hd', 'hq',
+                       'mv', 'ft', 'feat', 'the', 'a', 'by', 'and', 'of'))
+    # A misspelt word stands in for a known one sharing this much of its
+    # trigrams, counted at that similarity. Short words have to be exact.
+    FUZZY = 0.4
+    FUZZY_MIN_LENGTH = 4
+    FUZZY_VARIANTS = 3
+    # A search only resolves locally when one track matches at least
+    # CONFIDENT of its words, nothing else does, and the search also names
+    # MIN_TITLE_SHARE of that track's title.
+    CONFIDENT = 0.85
+    MIN_TITLE_SHARE = 0.4
+    # Candidates come from the rarest words' postings, up to MAX_SCAN
+    # entries, and the CANDIDATES most promising are scored exactly.
+    MAX_SCAN = 5000
+    CANDIDATES = 16
+
+    def __init__(self):
+        # Per track: (url, title, uploader, duration, words, title words).
+        # Replaced tracks leave a None behind so postings stay append-only.
+        self._docs = []
+        self._ids = {}
+        self._postings = {}
+        self._grams = collections.defaultdict(list)
+        self.hits = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    @staticmethod
+    def words(text: str):
+        return [word for word in re.findall(r'\w+', text.lower()) if word not in SearchIndex.NOISE]
+
+    @staticmethod
+    def trigrams(word: str):
+        padded = ' {} '.format(word)
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, track: Track):
+        if not track.url or not track.title:
+            return
+
+        title = frozenset(self.words(track.title))
+        words = title.union(self.words(' '.join([track.uploader or ''] + (track.tags or []))))
+        self._add((track.url, track.title, track.uploader, track.duration, words, title))
+
+    def _add(self, doc: tuple):
+        url, words = doc[0], doc[4]
+        doc_id = self._ids.get(url)
+        if doc_id is not None:
+            if self._docs[doc_id][4] == words:
+                return
+            self._docs[doc_id] = None
+
+        doc_id = len(self._docs)
+        self._docs.append(doc)
+        self._ids[url] = doc_id
+        for word in words:
+            posting = self._postings.get(word)
+            if posting is None:
+                posting = self._postings[word] = array.array('I')
+                for gram in self.trigrams(word):
+                    self._grams[gram].append(word)
+            posting.append(doc_id)
+
+    def variants(self, word: str):
+        # {known word: similarity} for one word of a search.
+        if word in self._postings:
+            return {word: 1.0}
+        if len(word) < self.FUZZY_MIN_LENGTH:
+            return {}
+
+        grams = self.trigrams(word)
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(self._grams.get(gram, ()))
+        similar = {known: 2 * count / (len(grams) + len(known)) for known, count in shared.items()}
+        ranked = sorted(similar.items(), key=lambda item: item[1], reverse=True)[:self.FUZZY_VARIANTS]
+        return {known: score for known, score in ranked if score >= self.FUZZY}
+
+    def search(self, query: str, limit: int = 5):
+        # [(words matched, title share, url, title, uploader, duration)], best first.
+        words = list(dict.fromkeys(self.words(query)))
+        if not words:
+            return []
+
+        variants = [self.variants(word) for word in words]
+        counts = collections.Counter()
+        scanned = 0
+        for postings in sorted(([self._postings[known] for known in found] for found in variants if found),
+                               key=lambda postings: sum(map(len, postings))):
+            size = sum(map(len, postings))
+            if scanned + size > self.MAX_SCAN and counts:
+                break
+            for posting in postings:
+                counts.update(posting)
+            scanned += size
+
+        results = []
+        for doc_id, _ in counts.most_common(self.CANDIDATES):
+            doc = self._docs[doc_id]
+            if doc is None:
+                continue
+            url, title, uploader, duration, doc_words, title_words = doc
+            matched = 0.0
+            named = set()
+            for found in variants:
+                best = max(((score, known) for known, score in found.items() if known in doc_words), default=None)
+                if best is not None:
+                    matched += best[0]
+                    named.add(best[1])
+            results.append((matched / len(words), len(named & title_words) / max(len(title_words), 1),
+                            url, title, uploader, duration))
+        results.sort(key=lambda result: result[:2], reverse=True)
+        return results[:limit]
+
+    def match(self, query: str):
+        # The page URL of the one track this search surely means, or None.
+        results = self.search(query, limit=2)
+        if not results:
+            return None
+
+        best = results[0]
+        if best[0] < self.CONFIDENT or best[1] < self.MIN_TITLE_SHARE:
+            return None
+        if len(results) > 1 and results[1][0] >= self.CONFIDENT:
+            return None
+        self.hits += 1
+        return best[2]
+
+    async def load(self, index: TrackIndex, *, loop: asyncio.BaseEventLoop = None):
+        # Built off the event loop; tracks resolved meanwhile are added on top.
+        loop = loop or asyncio.get_event_loop()
+        tracks = await index.tracks(loop=loop)
+        loaded = SearchIndex()
+        await loop.run_in_executor(None, lambda: [loaded.add(track) for track in tracks])
+
+        for doc in self._docs:
+            if doc is not None:
+                loaded._add(doc)
+        self._docs, self._ids = loaded._docs, loaded._ids
+        self._postings, self._grams = loaded._postings, loaded._grams
+        print("[INFO] {} TRACKS IN THE SEARCH INDEX".format(len(self)))
+
+
+class AudioCache:
+    # A track is downloaded once it has been played FILL_AFTER times.
+    FILL_AFTER = 2
+    # Partial downloads older than this are left over from a crash.
+    STALE_PARTIAL = 60 * 60
+    # When several shards share the directory, each one rescans it this often
+    # to pick up files the others downloaded or evicted.
+    SHARED_RESCAN = 5 * 60
+
+    DOWNLOAD_OPTIONS = {
+        'format': 'bestaudio/best',
+        'noplaylist': True,
+        'nocheckcertificate': True,
+        'quiet': True,
+        'no_warnings': True,
+        'source_address': '0.0.0.0',
+    }
+
+    def __init__(self, directory: str, *, max_bytes: int = 2 * 1024 ** 3, workers: int = 1):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='nia-audio')
+        self._entries = None
+        self._size = 0
+        self._plays = collections.Counter()
+        self._filling = set()
+        self.rescan = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries) if self._entries else 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @staticmethod
+    def key(track: Track):
+        if not track.id:
+            return None
+        # Files are named after the video id, so the same track is stored once.
+        return re.sub(r'[^A-Za-z0-9_-]', '_', track.id)
+
+    async def load(self, *, loop: asyncio.BaseEventLoop = None):
+        loop = loop or asyncio.get_event_loop()
+        found = await loop.run_in_executor(self._executor, self._scan)
+
+        previous = self._entries
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        for _, key, filename, size in sorted(found):
+            self._entries[key] = (filename, size)
+            self._size += size
+
+        if previous:
+            # Files we already knew keep the order we used them in; new ones
+            # from other shards count as older.
+            for key in previous:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+        self._evict(loop)
+
+    async def refresh(self, *, loop: asyncio.BaseEventLoop = None):
+        while True:
+            await asyncio.sleep(self.rescan)
+            try:
+                await self.load(loop=loop)
+            except OSError as e:
+                print("[ERROR] COULD NOT RESCAN THE AUDIO CACHE: {}".format(e))
+
+    def _scan(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        found = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            if entry.name.startswith('.'):
+                # A download that never finished. Recent ones may still be
+                # running in another shard.
+                if now - stat.st_mtime > self.STALE_PARTIAL:
+                    self._remove([entry.path])
+                continue
+
+            found.append((stat.st_mtime, entry.name.partition('.')[0], entry.name, stat.st_size))
+        return found
+
+    def lookup(self, track: Track):
+        key = self.key(track)
+        if self._entries is None or key is None:
+            return None
+
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        path = os.path.join(self.directory, entry[0])
+        if not os.path.exists(path):
+            del self._entries[key]
+            self._size -= entry[1]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return path
+
+    def played(self, track: Track, loop: asyncio.BaseEventLoop):
+        key = self.key(track)
+        if key is None or self._entries is None or key in self._entries or key in self._filling:
+            return
+
+        self._plays[key] += 1
+        if self._plays[key] >= self.FILL_AFTER:
+            del self._plays[key]
+            self._filling.add(key)
+            job = loop.run_in_executor(self._executor, self._download, key, track.url)
+            job.add_done_callback(functools.partial(self._filled, loop, key))
+        elif len(self._plays) > 4096:
+            self._plays = collections.Counter(dict(self._plays.most_common(1024)))
+
+    def _download(self, key: str, url: str):
+        partial = '.{}-{}.%(ext)s'.format(key, os.getpid())
+        options = dict(self.DOWNLOAD_OPTIONS, outtmpl=os.path.join(self.directory, partial))
+        with youtube_dl.YoutubeDL(options) as ydl:
+            info = ydl.extract_info(url, download=True)
+            partial = ydl.prepare_filename(info)
+
+        filename = '{}.{}'.format(key, info['ext'])
+        path = os.path.join(self.directory, filename)
+        os.replace(partial, path)
+        return filename, os.path.getsize(path)
+
+    def _filled(self, loop: asyncio.BaseEventLoop, key: str, job: asyncio.Future):
+        self._filling.discard(key)
+        if job.cancelled():
+            return
+        if job.exception() is not None:
+            print("[ERROR] COULD NOT CACHE '{}': {}".format(key, job.exception()))
+            return
+
+        self.add(key, *job.result(), loop=loop)
+
+    def add(self, key: str, filename: str, size: int, *, loop: asyncio.BaseEventLoop):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= old[1]
+
+        self._entries[key] = (filename, size)
+        self._size += size
+        self._evict(loop)
+
+    def _evict(self, loop: asyncio.BaseEventLoop):
+        victims = []
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            _, (filename, size) = self._entries.popitem(last=False)
+            self._size -= size
+            victims.append(os.path.join(self.directory, filename))
+
+        if victims:
+            loop.run_in_executor(self._executor, self._remove, victims)
+
+    @staticmethod
+    def _remove(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class LocalSpeedtest(speedtest.Speedtest):
+    # speedtest.Speedtest downloads its config from speedtest.net before it
+    # does anything else. Against a mini server that isn't needed, so this
+    # one starts from speedtest-cli's usual defaults and works offline.
+    CONFIG = {
+        'client': {'ip': '127.0.0.1', 'lat': '0', 'lon': '0', 'isp': 'local'},
+        'ignore_servers': [],
+        'sizes': {'upload': [524288, 1048576, 7340032],
+                  'download': [350, 500, 750, 1000, 1500, 2000, 2500, 3000, 3500, 4000]},
+        'counts': {'upload': 17, 'download': 4},
+        'threads': {'upload': 2, 'download': 8},
+        'length': {'upload': 10, 'download': 10},
+        'upload_max': 51,
+    }
+
+    def get_config(self):
+        self.config = json.loads(json.dumps(self.CONFIG))
+        self.lat_lon = (0.0, 0.0)
+        return self.config
+
+
+class ThroughputMonitor:
+    # A full speed test eats bandwidth the streams need, so it only runs
+    # every PROBE_INTERVAL seconds. The live figure is what our ffmpeg
+    # children have received over TCP, as the kernel counts it per socket;
+    # /proc/<pid>/io would miss it, since ffmpeg reads sockets with recv().
+    PROBE_INTERVAL = 60 * 60
+    SAMPLE_INTERVAL = 5
+    # Shards that don't probe pick up the shared result this often.
+    SHARED_REFRESH = 60
+
+    # sock_diag, see linux/inet_diag.h: dump every TCP socket with its tcp_info.
+    NETLINK_SOCK_DIAG = 4
+    SOCK_DIAG_BY_FAMILY = 20
+    NLM_F_DUMP_REQUEST = 0x301
+    NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    INET_DIAG_INFO = 2
+    # tcpi_bytes_received, Linux 4.1 and later.
+    BYTES_RECEIVED = struct.Struct('=Q')
+    BYTES_RECEIVED_OFFSET = 128
+
+    def __init__(self, *, mini_server: str = None, probe=None):
+        # `mini_server` points speedtest at a speedtest-mini style server,
+        # e.g. a local one for testing. `probe` replaces the speed test
+        # outright and must return a result dict like _speedtest does.
+        self.mini_server = mini_server
+        self._probe = probe or self._speedtest
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='nia-speedtest')
+        self._probing = None
+        # Only _sample touches these, one call at a time from run().
+        self._sockets = {}
+        self._closed_bytes = 0
+        self._bytes = 0
+        self._samples = collections.deque(maxlen=12)
+        self.measurable = sys.platform.startswith('linux')
+        self.result = None
+        self.error = None
+        # Under the launcher every shard shares one link, so only one of them
+        # runs the speed test and writes its result to `shared` for the rest.
+        self.probing = True
+        self.shared = None
+
+    @property
+    def streamed(self):
+        return self._bytes
+
+    @property
+    def live_rate(self):
+        # Bytes per second over the last minute; None where it can't be measured.
+        if not self.measurable:
+            return None
+        if len(self._samples) < 2:
+            return 0.0
+
+        (start, first), (end, last) = self._samples[0], self._samples[-1]
+        return (last - first) / (end - start)
+
+    @staticmethod
+    def megabits(rate):
+        if rate is None:
+            return 'Not measured here'
+        return '{:.2f} Mbps'.format(rate * 8 / 1000000)
+
+    @staticmethod
+    def _children():
+        parent = os.getpid()
+        children = []
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open('/proc/{}/stat'.format(name)) as f:
+                    # The command name is in parentheses and may contain anything.
+                    fields = f.read().rpartition(')')[2].split()
+            except OSError:
+                continue
+            if int(fields[1]) == parent:
+                children.append(name)
+        return children
+
+    @staticmethod
+    def _socket_inodes(pid: str):
+        inodes = set()
+        try:
+            names = os.listdir('/proc/{}/fd'.format(pid))
+        except OSError:
+            return inodes
+        for name in names:
+            try:
+                target = os.readlink('/proc/{}/fd/{}'.format(pid, name))
+            except OSError:
+                continue
+            if target.startswith('socket:['):
+                inodes.add(int(target[8:-1]))
+        return inodes
+
+    @classmethod
+    def _tcp_received(cls):
+        # {inode: bytes received} for every TCP socket on the host.
+        received = {}
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, cls.NETLINK_SOCK_DIAG) as sock:
+            for family in (socket.AF_INET, socket.AF_INET6):
+                request = struct.pack('=BBBxI48x', family, socket.IPPROTO_TCP,
+                                      1 << (cls.INET_DIAG_INFO - 1), 0xffffffff)
+                sock.send(struct.pack('=IHHII', 16 + len(request), cls.SOCK_DIAG_BY_FAMILY,
+                                      cls.NLM_F_DUMP_REQUEST, 0, 0) + request)
+                done = False
+                while not done:
+                    data = sock.recv(65536)
+                    offset = 0
+                    while offset + 16 <= len(data):
+                        length, kind = struct.unpack_from('=IH', data, offset)
+                        if kind == cls.NLMSG_DONE:
+                            done = True
+                            break
+                        if kind == cls.NLMSG_ERROR:
+                            raise OSError('sock_diag request failed')
+                        # inet_diag_msg is 72 bytes and ends with the inode.
+                        inode = struct.unpack_from('=I', data, offset + 16 + 68)[0]
+                        attr, end = offset + 16 + 72, offset + length
+                        while attr + 4 <= end:
+                            attr_length, attr_kind = struct.unpack_from('=HH', data, attr)
+                            if attr_length < 4:
+                                break
+                            if (attr_kind == cls.INET_DIAG_INFO
+                                    and attr_length >= 4 + cls.BYTES_RECEIVED_OFFSET + 8):
+                                received[inode] = cls.BYTES_RECEIVED.unpack_from(
+                                    data, attr + 4 + cls.BYTES_RECEIVED_OFFSET)[0]
+                            attr += (attr_length + 3) & ~3
+                        offset += (length + 3) & ~3
+        return received
+
+    def _sample(self):
+        received = self._tcp_received()
+        inodes = set()
+        for pid in self._children():
+            inodes |= self._socket_inodes(pid)
+
+        sockets = {inode: received[inode] for inode in inodes if inode in received}
+        # A socket that went away keeps what it had received when last seen.
+        self._closed_bytes += sum(count for inode, count in self._sockets.items() if inode not in sockets)
+        self._sockets = sockets
+        self._bytes = self._closed_bytes + sum(sockets.values())
+
+    def _speedtest(self):
+        if self.mini_server:
+            # Same as speedtest-cli's --mini.
+            test = LocalSpeedtest()
+            test.get_best_server(test.set_mini_server(self.mini_server))
+        else:
+            test = speedtest.Speedtest()
+            test.get_best_server()
+
+        return {
+            'download': test.download(),
+            'upload': test.upload(),
+            'ping': test.results.ping,
+            'server': test.results.server.get('sponsor') or test.results.server.get('host'),
+        }
+
+    def probe(self, *, loop: asyncio.BaseEventLoop = None):
+        if self._probing is None or self._probing.done():
+            loop = loop or asyncio.get_event_loop()
+            if self.probing:
+                self._probing = loop.create_task(self._run_probe(loop))
+            elif self.shared is not None:
+                self._probing = loop.create_task(self._read_shared(loop))
+        return self._probing
+
+    def _load_shared(self):
+        with open(self.shared) as f:
+            return json.load(f)
+
+    def _save_shared(self, result: dict):
+        with open(self.shared + '.tmp', 'w') as f:
+            json.dump(result, f)
+        os.replace(self.shared + '.tmp', self.shared)
+
+    async def _read_shared(self, loop: asyncio.BaseEventLoop):
+        try:
+            self.result = await loop.run_in_executor(self._executor, self._load_shared)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print("[ERROR] COULD NOT READ THE SHARED SPEED TEST: {}".format(e))
+
+    async def _run_probe(self, loop: asyncio.BaseEventLoop):
+        try:
+            result = await loop.run_in_executor(self._executor, self._probe)
+        except Exception as e:
+            self.error = (time.time(), str(e))
+            print("[ERROR] THROUGHPUT PROBE FAILED: {}".format(e))
+            return
+
+        result['measured_at'] = time.time()
+        self.result = result
+        if self.shared is not None:
+            try:
+                await loop.run_in_executor(self._executor, self._save_shared, result)
+            except OSError as e:
+                print("[ERROR] COULD NOT SHARE THE SPEED TEST: {}".format(e))
+
+    async def run(self, *, loop: asyncio.BaseEventLoop = None):
+        loop = loop or asyncio.get_event_loop()
+        # Give the bot a minute to settle before the first speed test.
+        next_probe = time.time() + 60
+        while True:
+            if self.measurable:
+                try:
+                    await loop.run_in_executor(None, self._sample)
+                    self._samples.append((time.monotonic(), self._bytes))
+                except (OSError, ValueError, IndexError, struct.error) as e:
+                    self.measurable = False
+                    print("[WARN] CANNOT MEASURE STREAM THROUGHPUT: {}".format(e))
+            if time.time() >= next_probe:
+                self.probe(loop=loop)
+                next_probe = time.time() + (self.PROBE_INTERVAL if self.probing else self.SHARED_REFRESH)
+            await asyncio.sleep(self.SAMPLE_INTERVAL)
+
+
+class Prewarmable:
+    # Live ffmpeg processes across every source.
+    processes = 0
+    spawns_process = True
+
+    def _setup_prewarm(self):
+        self._prewarmed = collections.deque()
+        self._warming = None
+        self._started = False
+        self._closed = not self.spawns_process
+        if self.spawns_process:
+            Prewarmable.processes += 1
+
+    def cleanup(self):
+        if not self._closed:
+            self._closed = True
+            Prewarmable.processes -= 1
+        super().cleanup()
+
+    def prewarm(self, frames: int, *, loop: asyncio.BaseEventLoop):
+        if self._warming is None and not self._started:
+            self._warming = loop.run_in_executor(None, self._fill, frames)
+        return self._warming
+
+    async def ready(self):
+        # Once playback starts only the voice client may read from ffmpeg.
+        self._started = True
+        if self._warming is not None:
+            await self._warming
+
+    def _fill(self, frames: int):
+        # Runs before the voice client starts reading, so ffmpeg has already
+        # connected and decoded the opening frames by the time we hand off.
+        while len(self._prewarmed) < frames:
+            data = self._read_frame()
+            if not data:
+                break
+            self._prewarmed.append(data)
+
+
+class PCMEngine:
+    # Gain, crossfade mixing and loudness measurement for 16-bit stereo PCM.
+    # With NumPy a batch of frames is handled in one pass; without it audioop
+    # goes frame by frame, as discord.PCMVolumeTransformer does.
+    BATCH = 5
+    FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+    FRAMES_PER_SECOND = 50
+    # Tracks are levelled towards this average, within MAX_CUT and MAX_BOOST dB.
+    # Most masters already sit close to it, so a track that hasn't been
+    # measured yet is assumed to be there and plays as is.
+    TARGET_LOUDNESS = -11.0
+    MAX_BOOST = 6.0
+    MAX_CUT = -15.0
+    # A measurement needs at least this many seconds of audio to be kept.
+    MIN_MEASURED = 10
+
+    @classmethod
+    def track_gain(cls, track: Track):
+        if track.loudness is None:
+            return 1.0
+        db = min(max(cls.TARGET_LOUDNESS - track.loudness, cls.MAX_CUT), cls.MAX_BOOST)
+        return 10 ** (db / 20)
+
+    @staticmethod
+    def loudness(power: float, samples: int):
+        if samples < PCMEngine.MIN_MEASURED * PCMEngine.FRAMES_PER_SECOND * PCMEngine.FRAME_SIZE // 2:
+            return None
+        if power <= 0:
+            return -96.0
+        return 10 * math.log10(power / samples / 32768 ** 2)
+
+    @staticmethod
+    def power(data: bytes):
+        if numpy is not None:
+            samples = numpy.frombuffer(data, numpy.int16).astype(numpy.float32)
+            return float(numpy.dot(samples, samples))
+        return float(audioop.rms(data, 2)) ** 2 * (len(data) // 2)
+
+    @staticmethod
+    def gain(data: bytes, factor: float):
+        if factor == 1.0:
+            return data
+        if numpy is not None:
+            samples = numpy.frombuffer(data, numpy.int16) * numpy.float32(factor)
+            return numpy.clip(samples, -32768, 32767, out=samples).astype(numpy.int16).tobytes()
+        return b''.join(audioop.mul(data[i:i + PCMEngine.FRAME_SIZE], 2, factor)
+                        for i in range(0, len(data), PCMEngine.FRAME_SIZE))
+
+    @staticmethod
+    def mix(first: bytes, second: bytes, first_gain: float, second_gain: float, start: float, end: float):
+        # Fades `first` out and `second` in; `start` and `end` are how far
+        # through the crossfade (0 to 1) this batch begins and ends.
+        if numpy is not None:
+            ramp = numpy.linspace(start, end, len(first) // 4, endpoint=False, dtype=numpy.float32).repeat(2)
+            samples = (numpy.frombuffer(first, numpy.int16) * ((1 - ramp) * first_gain)
+                       + numpy.frombuffer(second, numpy.int16) * (ramp * second_gain))
+            return numpy.clip(samples, -32768, 32767, out=samples).astype(numpy.int16).tobytes()
+
+        frames = len(first) // PCMEngine.FRAME_SIZE
+        mixed = []
+        for index in range(frames):
+            fade = start + (end - start) * index / frames
+            chunk = slice(index * PCMEngine.FRAME_SIZE, (index + 1) * PCMEngine.FRAME_SIZE)
+            mixed.append(audioop.add(audioop.mul(first[chunk], 2, (1 - fade) * first_gain),
+                                     audioop.mul(second[chunk], 2, fade * second_gain), 2))
+        return b''.join(mixed)
+
+
+class Extractor:
+    # What the player needs from youtube_dl. The methods block, so they are
+    # run on the extraction scheduler's threads, and each returns a
+    # youtube_dl style info dict or None.
+    def search(self, query: str):
+        # Unprocessed: no format selection, and search results are left as entries.
+        raise NotImplementedError
+
+    def process(self, info: dict):
+        # Full info with a playable `url` for an entry or search result.
+        raise NotImplementedError
+
+    def playlist(self, url: str):
+        # Flat entries only; `entries` may be a lazy generator.
+        raise NotImplementedError
+
+
+class YoutubeDLExtractor(Extractor):
+    def __init__(self, options: dict, playlist_options: dict):
+        self.options = options
+        self.playlist_options = playlist_options
+        self._ytdl = None
+        self._playlist_ytdl = None
+
+    # Built on first use, so importing the module doesn't set up youtube_dl.
+    @property
+    def ytdl(self):
+        if self._ytdl is None:
+            self._ytdl = youtube_dl.YoutubeDL(self.options)
+        return self._ytdl
+
+    @property
+    def playlist_ytdl(self):
+        if self._playlist_ytdl is None:
+            self._playlist_ytdl = youtube_dl.YoutubeDL(self.playlist_options)
+        return self._playlist_ytdl
+
+    def search(self, query: str):
+        return self.ytdl.extract_info(query, download=False, process=False)
+
+    def process(self, info: dict):
+        if info.get('_type', 'video') == 'video' and info.get('formats'):
+            # The unprocessed result already carries the format list, so only
+            # format selection is left to do and the page needn't be fetched again.
+            return self.ytdl.process_ie_result(info, download=False)
+        return self.ytdl.extract_info(info.get('webpage_url') or info['url'], download=False)
+
+    def playlist(self, url: str):
+        return self.playlist_ytdl.extract_info(url, download=False, process=False)
+
+
+class YTDLSource(Prewarmable, discord.PCMVolumeTransformer):
     YTDL_OPTIONS = {
         'format': 'bestaudio/best',
         'extractaudio': True,
@@ -46,62 +1504,205 @@ class YTDLSource(discord.PCMVolumeTransformer):
         'options': '-vn',
     }
 
-    ytdl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
-
-    def __init__(self, ctx: commands.Context, source: discord.FFmpegPCMAudio, *, data: dict, volume: float = 0.5):
-        super().__init__(source, volume)
-
-        self.requester = ctx.author
-        self.channel = ctx.channel
-        self.data = data
-
-        self.uploader = data.get('uploader')
-        self.uploader_url = data.get('uploader_url')
-        date = data.get('upload_date')
-        self.upload_date = date[6:8] + '.' + date[4:6] + '.' + date[0:4]
-        self.title = data.get('title')
-        self.thumbnail = data.get('thumbnail')
-        self.description = data.get('description')
-        self.duration = self.parse_duration(int(data.get('duration')))
-        self.tags = data.get('tags')
-        self.url = data.get('webpage_url')
-        self.views = data.get('view_count')
-        self.likes = data.get('like_count')
-        self.dislikes = data.get('dislike_count')
-        self.stream_url = data.get('url')
+    LOCAL_FFMPEG_OPTIONS = {
+        'before_options': '',
+        'options': '-vn',
+    }
+
+    # Playlists are only enumerated here; each entry is looked up through
+    # `resolve` once it gets close to the head of the queue.
+    PLAYLIST_OPTIONS = dict(YTDL_OPTIONS, noplaylist=False, extract_flat='in_playlist')
+    PLAYLIST_BATCH = 50
+    PLAYLIST_LIMIT = 1000
+
+    extractor = YoutubeDLExtractor(YTDL_OPTIONS, PLAYLIST_OPTIONS)
+    # Level tracks using their measured loudness.
+    NORMALIZE = True
+    cache = ExtractionCache()
+    index = TrackIndex('tracks.sqlite3')
+    search_index = SearchIndex()
+    audio_cache = AudioCache('audio-cache')
+    throughput = ThroughputMonitor()
+    inflight = SingleFlight()
+    scheduler = ExtractionScheduler(workers=4, max_backlog=64, max_guild_backlog=16)
+
+    def __init__(self, track: Track, *, volume: float = 0.5, start: float = 0, path: str = None):
+        options = dict(self.FFMPEG_OPTIONS if path is None else self.LOCAL_FFMPEG_OPTIONS)
+        if start:
+            options['before_options'] += ' -ss {:.0f}'.format(start)
+        super().__init__(discord.FFmpegPCMAudio(path or track.stream_url, **options), volume)
+
+        self.track = track
+        self.gain = PCMEngine.track_gain(track) if self.NORMALIZE else 1.0
+        # Frames still to come, when the duration is known; the crossfade starts from it.
+        self._remaining = (track.duration - start) * PCMEngine.FRAMES_PER_SECOND if track.duration else None
+        self._batch = collections.deque()
+        # (next source, frames) while chained for a crossfade.
+        self._fade = None
+        self._faded = 0
+        # Only measured while the track has no loudness on record.
+        self._measure = track.loudness is None
+        self._power = 0.0
+        self._samples = 0
+        self._setup_prewarm()
 
     def __str__(self):
-        return '**{0.title}** by **{0.uploader}**'.format(self)
+        return str(self.track)
+
+    @property
+    def loudness(self):
+        return PCMEngine.loudness(self._power, self._samples) if self._measure else None
+
+    def fade_into(self, source: 'YTDLSource', frames: int = 0):
+        # The opening of `source` is mixed into our last `frames` and it
+        # carries on from there once it plays; None unchains it again.
+        self._fade = (source, frames) if source is not None and frames > 0 else None
+
+    def _next_frames(self, count: int):
+        frames = []
+        while len(frames) < count:
+            data = self._prewarmed.popleft() if self._prewarmed else self._read_frame()
+            if len(data) != PCMEngine.FRAME_SIZE:
+                break
+            frames.append(data)
+        return frames
+
+    def _fill_batch(self):
+        frames = self._next_frames(PCMEngine.BATCH)
+        if not frames:
+            return
+
+        data = b''.join(frames)
+        if self._measure:
+            self._power += PCMEngine.power(data)
+            self._samples += len(data) // 2
+
+        volume = min(self.volume, 2.0) * self.gain
+        if self._remaining is not None:
+            self._remaining -= len(frames)
+
+        # Read once: the event loop may rechain while we play.
+        fade = self._fade
+        if fade is not None and self._remaining is not None and self._remaining < fade[1]:
+            following, length = fade
+            incoming = []
+            if not (following._started or following._closed
+                    or (following._warming is not None and not following._warming.done())):
+                try:
+                    incoming = following._next_frames(len(frames))
+                except Exception:
+                    pass
+
+            if len(incoming) == len(frames):
+                # Those frames are gone from the next song, which fades into
+                # the one after it by the same count.
+                if following._remaining is not None:
+                    following._remaining -= len(incoming)
+                start = self._faded / length
+                self._faded = min(self._faded + len(frames), length)
+                data = PCMEngine.mix(data, b''.join(incoming), volume,
+                                     min(following.volume, 2.0) * following.gain,
+                                     start, self._faded / length)
+            else:
+                self._fade = None
+                data = PCMEngine.gain(data, volume)
+        else:
+            data = PCMEngine.gain(data, volume)
+
+        size = PCMEngine.FRAME_SIZE
+        self._batch.extend(data[i:i + size] for i in range(0, len(data), size))
+
+    def read(self):
+        if not self._batch:
+            self._fill_batch()
+        return self._batch.popleft() if self._batch else b''
+
+    def _read_frame(self):
+        return self.original.read()
 
     @classmethod
-    async def create_source(cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None):
+    def playable(cls, track: Track):
+        return track.resolved or cls.audio_cache.lookup(track) is not None
+
+    @classmethod
+    async def resolve(cls, search: str, *, loop: asyncio.BaseEventLoop = None, guild_id=None):
         loop = loop or asyncio.get_event_loop()
 
-        partial = functools.partial(
-            cls.ytdl.extract_info, search, download=False, process=False)
-        data = await loop.run_in_executor(None, partial)
+        query_key = 'query:' + ExtractionCache.normalize(search)
+        track = cls.cache.get(query_key)
+        if track is not None:
+            return track
 
-        if data is None:
-            raise YTDLError(
-                'Sorry, But I couldn\'t find anything that matched `{}`'.format(search))
+        return await cls.inflight.run(query_key, lambda: cls._lookup(search, query_key, loop, guild_id))
 
-        if 'entries' not in data:
-            process_info = data
+    @classmethod
+    async def _lookup(cls, search: str, query_key: str, loop: asyncio.BaseEventLoop, guild_id):
+        stored = await cls.index.get(query_key, loop=loop)
+        if stored is not None and stored.loudness is None:
+            # Loudness is measured after the lookup and only stored under the
+            # page URL; copy it onto this query once it's there.
+            by_url = await cls.index.get('url:' + stored.url, loop=loop)
+            if by_url is not None and by_url.loudness is not None:
+                stored.loudness = by_url.loudness
+                cls.index.put([query_key], stored)
+
+        if stored is not None and cls.playable(stored):
+            cls.cache.put([query_key, 'url:' + stored.url], stored)
+            return stored
+
+        local = None
+        if stored is None and not urllib.parse.urlparse(search).scheme:
+            local = cls.search_index.match(search)
+
+        if stored is not None or local is not None:
+            # We already know which video this query lands on, so only its
+            # stream needs to be looked up again.
+            process_info = {'webpage_url': stored.url if stored is not None else local}
         else:
-            process_info = None
-            for entry in data['entries']:
-                if entry:
-                    process_info = entry
-                    break
+            started = time.perf_counter()
+            data = await cls.scheduler.run(guild_id, functools.partial(cls.extractor.search, search))
+            metrics.observe('nia_extraction_seconds', time.perf_counter() - started, stage='search')
 
-            if process_info is None:
+            if data is None:
                 raise YTDLError(
                     'Sorry, But I couldn\'t find anything that matched `{}`'.format(search))
 
-        webpage_url = process_info['webpage_url']
-        partial = functools.partial(
-            cls.ytdl.extract_info, webpage_url, download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+            if 'entries' not in data:
+                process_info = data
+            else:
+                process_info = None
+                for entry in data['entries']:
+                    if entry:
+                        process_info = entry
+                        break
+
+                if process_info is None:
+                    raise YTDLError(
+                        'Sorry, But I couldn\'t find anything that matched `{}`'.format(search))
+
+        webpage_url = process_info.get('webpage_url') or process_info['url']
+        url_key = 'url:' + webpage_url
+        track = cls.cache.get(url_key)
+        if track is None:
+            # Different queries often land on the same video, so the second
+            # pass is coalesced on the page URL as well.
+            track = await cls.inflight.run(url_key, lambda: cls._process(process_info, url_key, loop, guild_id))
+
+        cls.cache.put([query_key], track)
+        cls.index.put([query_key], track)
+        return track
+
+    @classmethod
+    async def _process(cls, process_info: dict, url_key: str, loop: asyncio.BaseEventLoop, guild_id):
+        webpage_url = url_key[len('url:'):]
+        stored = await cls.index.get(url_key, loop=loop)
+        if stored is not None and cls.playable(stored):
+            cls.cache.put([url_key], stored)
+            return stored
+
+        started = time.perf_counter()
+        processed_info = await cls.scheduler.run(guild_id, functools.partial(cls.extractor.process, process_info))
+        metrics.observe('nia_extraction_seconds', time.perf_counter() - started, stage='process')
 
         if processed_info is None:
             raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
@@ -117,7 +1718,45 @@ class YTDLSource(discord.PCMVolumeTransformer):
                     raise YTDLError(
                         'Couldn\'t retrieve any matches for `{}`'.format(webpage_url))
 
-        return cls(ctx, discord.FFmpegPCMAudio(info['url'], **cls.FFMPEG_OPTIONS), data=info)
+        # Only the compact record outlives this call; the info dict is dropped.
+        track = Track.from_info(info)
+        if stored is not None:
+            track.loudness = stored.loudness
+        keys = [url_key, 'url:' + (track.url or webpage_url)]
+        cls.cache.put(keys, track)
+        cls.index.put(keys, track)
+        cls.search_index.add(track)
+        return track
+
+    @classmethod
+    async def iter_playlist(cls, url: str, *, loop: asyncio.BaseEventLoop = None, guild_id=None):
+        data = await cls.scheduler.run(guild_id, functools.partial(cls.extractor.playlist, url))
+
+        if data is None:
+            raise YTDLError(
+                'Sorry, But I couldn\'t find anything that matched `{}`'.format(url))
+
+        if 'entries' not in data:
+            yield [Track.from_entry(data)]
+            return
+
+        # Entries are usually a lazy generator that fetches playlist pages as
+        # it goes, so pull them off in batches instead of materializing them.
+        entries = iter(data['entries'])
+        remaining = cls.PLAYLIST_LIMIT
+        while remaining > 0:
+            partial = functools.partial(
+                cls._take, entries, min(cls.PLAYLIST_BATCH, remaining))
+            batch = await cls.scheduler.run(guild_id, partial)
+            if not batch:
+                return
+
+            remaining -= len(batch)
+            yield [Track.from_entry(entry) for entry in batch if entry]
+
+    @staticmethod
+    def _take(entries, count: int):
+        return list(itertools.islice(entries, count))
 
     @staticmethod
     def parse_duration(duration: int):
@@ -138,71 +1777,986 @@ class YTDLSource(discord.PCMVolumeTransformer):
         return ', '.join(duration)
 
 
-class Song:
-    __slots__ = ('source', 'requester')
+class YTDLOpusSource(Prewarmable, discord.FFmpegOpusAudio):
+    # ffmpeg hands over Opus packets that go out as they are, so there is no
+    # per-frame volume scaling or encoding in Python. Opus streams are only
+    # remuxed and play at their own level; anything else is encoded by ffmpeg
+    # at the guild's volume and loudness gain, fixed when the song starts.
+    BITRATE = 128
+
+    def __init__(self, track: Track, *, volume: float = 0.5, start: float = 0, path: str = None):
+        options = dict(YTDLSource.FFMPEG_OPTIONS if path is None else YTDLSource.LOCAL_FFMPEG_OPTIONS)
+        if start:
+            options['before_options'] += ' -ss {:.0f}'.format(start)
+
+        # A straight remux can't be levelled, so volume and loudness only apply
+        # when encoding; then they match what the PCM path would play.
+        if track.codec == 'opus':
+            codec = 'opus'
+        else:
+            codec = None
+            gain = PCMEngine.track_gain(track) if YTDLSource.NORMALIZE else 1.0
+            options['options'] += ' -filter:a volume={:.3f}'.format(min(volume, 2.0) * gain)
+
+        super().__init__(path or track.stream_url, codec=codec, bitrate=self.BITRATE, **options)
+
+        self.track = track
+        # Changes aren't applied mid-song; kept so callers can treat both sources alike.
+        self.volume = volume
+        self._setup_prewarm()
+
+    def __str__(self):
+        return str(self.track)
+
+    def read(self):
+        if self._prewarmed:
+            return self._prewarmed.popleft()
+        return super().read()
 
-    def __init__(self, source: YTDLSource):
+    def _read_frame(self):
+        return super().read()
+
+
+class VoiceTransport:
+    # Where a guild's audio comes from and where it goes. `connect` returns
+    # something that behaves like a discord.VoiceClient and `open` builds the
+    # AudioSource for a track, which may spawn a process.
+    async def connect(self, channel: discord.VoiceChannel):
+        raise NotImplementedError
+
+    def open(self, track: Track, *, volume: float, start: float = 0, path: str = None, opus: bool = False):
+        raise NotImplementedError
+
+
+class DiscordTransport(VoiceTransport):
+    async def connect(self, channel: discord.VoiceChannel):
+        return await channel.connect()
+
+    def open(self, track: Track, *, volume: float, start: float = 0, path: str = None, opus: bool = False):
+        if path is None and not track.resolved:
+            raise YTDLError('Couldn\'t fetch `{}`'.format(track.url))
+
+        cls = YTDLOpusSource if opus else YTDLSource
+        return cls(track, volume=volume, start=start, path=path)
+
+
+class Broadcast:
+    # One decode of a track, shared by every guild tuned into the same
+    # channel. Frames go into a ring that each listener reads with its own
+    # cursor, and whichever voice client asks for a new frame first decodes
+    # it. Listeners that join late, or fall a whole ring behind, pick up at
+    # the live position.
+    RING_FRAMES = 250
+    # (channel, track url) -> Broadcast
+    live = {}
+    _tuning = threading.Lock()
+
+    def __init__(self, key: tuple, source: discord.AudioSource):
+        self.key = key
         self.source = source
-        self.requester = source.requester
+        self.listeners = 0
+        self.ended = False
+        self._ring = [None] * self.RING_FRAMES
+        self._head = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def tune(cls, channel: str, track: Track, open_source):
+        with cls._tuning:
+            key = (channel, track.url)
+            broadcast = cls.live.get(key)
+            if broadcast is None or broadcast.ended:
+                broadcast = cls.live[key] = cls(key, open_source())
+            broadcast.listeners += 1
+            return broadcast
+
+    def leave(self):
+        with self._tuning:
+            self.listeners -= 1
+            if self.listeners > 0:
+                return
+            if self.live.get(self.key) is self:
+                del self.live[self.key]
+        self.source.cleanup()
+
+    async def ready(self):
+        if isinstance(self.source, Prewarmable):
+            await self.source.ready()
+
+    def frame(self, cursor: int):
+        # Called from the voice clients' player threads. Returns the frame at
+        # `cursor` and where that listener reads next.
+        with self._lock:
+            if cursor is None or cursor < self._head - self.RING_FRAMES:
+                cursor = self._head
+            if cursor == self._head:
+                if self.ended:
+                    return b'', cursor
+                data = self.source.read()
+                if len(data) != PCMEngine.FRAME_SIZE:
+                    self.ended = True
+                    return b'', cursor
+                self._ring[self._head % self.RING_FRAMES] = data
+                self._head += 1
+            return self._ring[cursor % self.RING_FRAMES], cursor + 1
+
+
+class BroadcastSource(Prewarmable, discord.AudioSource):
+    # One guild listening to a Broadcast, at its own volume. Songs are opened
+    # well before they play, so the guild only tunes in once playback starts;
+    # otherwise the broadcast could end, or be played forward by another
+    # guild, while this one is still waiting for its turn.
+    spawns_process = False
+
+    def __init__(self, tune, track: Track, *, volume: float = 0.5):
+        self.broadcast = None
+        self.track = track
+        self.volume = volume
+        self._tune = tune
+        self._cursor = None
+        self._setup_prewarm()
+
+    def __str__(self):
+        return str(self.track)
+
+    def prewarm(self, frames: int, *, loop: asyncio.BaseEventLoop):
+        # Nothing to decode ahead: a broadcast is joined at its live position.
+        return None
+
+    def _tuned(self):
+        if self.broadcast is None and self._tune is not None:
+            self.broadcast, self._tune = self._tune(), None
+        return self.broadcast
+
+    async def ready(self):
+        self._started = True
+        await self._tuned().ready()
+
+    def read(self):
+        broadcast = self._tuned()
+        if broadcast is None:
+            return b''
+        data, self._cursor = broadcast.frame(self._cursor)
+        return PCMEngine.gain(data, min(self.volume, 2.0)) if data else b''
+
+    def cleanup(self):
+        self._tune = None
+        if self.broadcast is not None:
+            self.broadcast.leave()
+            self.broadcast = None
+        super().cleanup()
+
+
+class BroadcastTransport(VoiceTransport):
+    # Tunes a guild into a shared channel: a track that is already playing
+    # there is joined live instead of being fetched and decoded again.
+    # Opus passthrough and resumed songs still get a source of their own.
+    def __init__(self, channel: str, transport: VoiceTransport):
+        self.channel = channel
+        self.transport = transport
+
+    async def connect(self, channel: discord.VoiceChannel):
+        return await self.transport.connect(channel)
+
+    def open(self, track: Track, *, volume: float, start: float = 0, path: str = None, opus: bool = False):
+        if opus or start:
+            return self.transport.open(track, volume=volume, start=start, path=path, opus=opus)
+
+        return BroadcastSource(
+            lambda: Broadcast.tune(self.channel, track, lambda: self.transport.open(track, volume=1.0, path=path)),
+            track, volume=volume)
+
+
+class Song:
+    __slots__ = ('track', 'requester', 'channel', 'source', 'queued_at', '_line', '_embed')
+
+    def __init__(self, track: Track, requester: discord.Member, channel: discord.TextChannel):
+        self.track = track
+        self.requester = requester
+        self.channel = channel
+        # Built only when the song is about to play, since it spawns ffmpeg.
+        self.source = None
+        self.queued_at = None
+        # Rendered once per track; see queue_line and create_embed.
+        self._line = None
+        self._embed = None
+
+    async def resolve(self, loop: asyncio.BaseEventLoop):
+        if not YTDLSource.playable(self.track):
+            self.track = await YTDLSource.resolve(self.track.url, loop=loop, guild_id=self.channel.guild.id)
+        return self.track
+
+    async def revalidate(self, loop: asyncio.BaseEventLoop):
+        track = await self.resolve(loop)
+        if track.stale and YTDLSource.audio_cache.lookup(track) is None:
+            self.close()
+            self.track = await YTDLSource.resolve(track.url, loop=loop, guild_id=self.channel.guild.id)
+        return self.track
+
+    def open(self, transport: VoiceTransport, volume: float, start: float = 0, opus: bool = False):
+        if self.source is None:
+            path = YTDLSource.audio_cache.lookup(self.track)
+            self.source = transport.open(self.track, volume=volume, start=start, path=path, opus=opus)
+        return self.source
+
+    def close(self):
+        if self.source is not None:
+            self.source.cleanup()
+            self.source = None
+
+    def queue_line(self):
+        if self._line is None or self._line[0] is not self.track:
+            # Titles come from uploaders and can be any length or contain markdown.
+            title = self.track.title or self.track.url or '?'
+            if len(title) > QueuePages.TITLE_LIMIT:
+                title = title[:QueuePages.TITLE_LIMIT - 1] + '…'
+            title = discord.utils.escape_markdown(title).replace('[', '\\[').replace(']', '\\]')
+
+            line = '[**{}**]({})'.format(title, self.track.url)
+            if len(line) > QueuePages.LINE_LIMIT:
+                line = '**{}**'.format(title)
+            self._line = (self.track, line)
+        return self._line[1]
 
     def create_embed(self):
+        if self._embed is None or self._embed[0] is not self.track:
+            self._embed = (self.track, self._build_embed())
+        return self._embed[1]
+
+    def _build_embed(self):
         embed = (discord.Embed(title='Now playing',
-                               description='```css\n{0.source.title}\n```'.format(
+                               description='```css\n{0.track.title}\n```'.format(
                                    self),
                                color=discord.Color.blurple())
-                 .add_field(name='Duration', value=self.source.duration)
+                 .add_field(name='Duration', value=self.track.duration_text)
                  .add_field(name='Requested by', value=self.requester.mention)
-                 .add_field(name='Uploader', value='[{0.source.uploader}]({0.source.uploader_url})'.format(self))
-                 .add_field(name='URL', value='[Click]({0.source.url})'.format(self))
-                 .add_field(name="Views", value='({0.source.views})'.format(self))
-                 .set_thumbnail(url=self.source.thumbnail))
+                 .add_field(name='Uploader', value='[{0.track.uploader}]({0.track.uploader_url})'.format(self))
+                 .add_field(name='URL', value='[Click]({0.track.url})'.format(self))
+                 .add_field(name="Views", value='({0.track.views})'.format(self))
+                 .set_thumbnail(url=self.track.thumbnail))
         return embed
 
+    def to_dict(self):
+        return {'track': self.track.to_dict(), 'requester': self.requester.id, 'channel': self.channel.id}
+
+    @classmethod
+    def from_dict(cls, data: dict, guild: discord.Guild):
+        requester = guild.get_member(data['requester']) or guild.me
+        channel = guild.get_channel(data['channel']) or guild.system_channel or guild.text_channels[0]
+        return cls(Track(**data['track']), requester, channel)
+
     def currentPlayerURL(self):
-        return ['{0.source.title}'.format(self),'{0.source.url}'.format(self)]
+        return ['{0.track.title}'.format(self),'{0.track.url}'.format(self)]
+
+
+class QueuePages:
+    # Rendered `nia queue` pages. A queue change only drops the pages from
+    # the one it touched onwards, and each song's line is formatted once.
+    PER_PAGE = 10
+    TITLE_LIMIT = 80
+    # Keeps a full page well inside Discord's 2048 character description limit.
+    LINE_LIMIT = 190
+
+    def __init__(self, songs):
+        self.songs = songs
+        self._pages = {}
+
+    @property
+    def count(self):
+        return max(math.ceil(len(self.songs) / self.PER_PAGE), 1)
+
+    def invalidate(self, index: int = 0):
+        first = index // self.PER_PAGE + 1
+        for page in [page for page in self._pages if page >= first]:
+            del self._pages[page]
+
+    def changed(self, op: dict):
+        kind = op['op']
+        if kind == 'put':
+            self.invalidate(len(self.songs) - 1)
+        elif kind in ('insert', 'remove'):
+            self.invalidate(op['index'])
+        elif kind == 'move':
+            self.invalidate(min(op['from'], op['to']))
+        elif kind in ('get', 'shuffle', 'clear'):
+            self.invalidate(0)
+
+    def render(self, page: int):
+        text = self._pages.get(page)
+        if text is None:
+            start = (page - 1) * self.PER_PAGE
+            text = '\n'.join('`{}.` {}'.format(index + 1, song.queue_line()) for index, song in enumerate(
+                self.songs[start:start + self.PER_PAGE], start=start))
+            self._pages[page] = text
+        return text
+
+    def embed(self, page: int):
+        page = min(max(page, 1), self.count)
+        return (discord.Embed(title='Okay... This is the current queue list',
+                              description='**{} tracks:**\n\n{}'.format(len(self.songs), self.render(page)))
+                .set_footer(text='Viewing page {}/{} · {} in total'.format(
+                    page, self.count, YTDLSource.parse_duration(self.songs.duration) or 'nothing')))
+
+
+class SongTree:
+    # An implicit treap: songs are ordered by position alone and every node
+    # carries the size and total duration of its subtree, so indexing,
+    # inserting and removing anywhere in the queue are O(log n). Each
+    # requester's nodes are also kept in queue order, for per-user limits
+    # and fair inserts.
+
+    class Node:
+        __slots__ = ('song', 'priority', 'left', 'right', 'parent', 'size', 'duration')
+
+        def __init__(self, song: Song):
+            self.song = song
+            self.priority = random.random()
+            self.left = None
+            self.right = None
+            self.parent = None
+            self.size = 1
+            self.duration = song.track.duration or 0
+
+    def __init__(self):
+        self._root = None
+        self._nodes = {}
+        self._by_requester = collections.defaultdict(list)
+
+    def __len__(self):
+        return self._root.size if self._root else 0
+
+    def __iter__(self):
+        return (node.song for node in self._iter_from(0))
+
+    @property
+    def duration(self):
+        return self._root.duration if self._root else 0
+
+    @staticmethod
+    def requester(song: Song):
+        return song.requester.id
+
+    @staticmethod
+    def _update(node):
+        node.size = 1
+        node.duration = node.song.track.duration or 0
+        for child in (node.left, node.right):
+            if child is not None:
+                child.parent = node
+                node.size += child.size
+                node.duration += child.duration
+
+    def _merge(self, left, right):
+        if left is None:
+            return right
+        if right is None:
+            return left
+
+        if left.priority > right.priority:
+            left.right = self._merge(left.right, right)
+            self._update(left)
+            return left
+
+        right.left = self._merge(left, right.left)
+        self._update(right)
+        return right
+
+    def _split(self, node, count: int):
+        # Returns the first `count` nodes and the rest as two trees.
+        if node is None:
+            return None, None
+
+        left_size = node.left.size if node.left else 0
+        if count <= left_size:
+            left, node.left = self._split(node.left, count)
+            self._update(node)
+            if left is not None:
+                left.parent = None
+            return left, node
+
+        node.right, right = self._split(node.right, count - left_size - 1)
+        self._update(node)
+        if right is not None:
+            right.parent = None
+        return node, right
+
+    def _set_root(self, node):
+        self._root = node
+        if node is not None:
+            node.parent = None
+
+    def _node(self, index: int):
+        node = self._root
+        while node is not None:
+            left_size = node.left.size if node.left else 0
+            if index < left_size:
+                node = node.left
+            elif index == left_size:
+                return node
+            else:
+                index -= left_size + 1
+                node = node.right
+        raise IndexError('queue index out of range')
+
+    def _iter_from(self, index: int):
+        stack = []
+        node = self._root
+        while node is not None:
+            left_size = node.left.size if node.left else 0
+            if index <= left_size:
+                stack.append(node)
+                if index == left_size:
+                    break
+                node = node.left
+            else:
+                index -= left_size + 1
+                node = node.right
+
+        while stack:
+            node = stack.pop()
+            yield node
+            node = node.right
+            while node is not None:
+                stack.append(node)
+                node = node.left
+
+    def index_of(self, node):
+        index = node.left.size if node.left else 0
+        while node.parent is not None:
+            parent = node.parent
+            if node is parent.right:
+                index += (parent.left.size if parent.left else 0) + 1
+            node = parent
+        return index
+
+    def get(self, index: int):
+        return self._node(index).song
+
+    def slice(self, start: int, stop: int):
+        return [node.song for node in itertools.islice(self._iter_from(start), max(stop - start, 0))]
+
+    def elapsed_before(self, index: int):
+        # Total duration of the songs ahead of `index`.
+        total = 0
+        node = self._root
+        while node is not None:
+            left_size = node.left.size if node.left else 0
+            left_duration = node.left.duration if node.left else 0
+            if index <= left_size:
+                node = node.left
+            else:
+                total += left_duration + (node.song.track.duration or 0)
+                index -= left_size + 1
+                node = node.right
+        return total
+
+    def insert(self, index: int, song: Song):
+        node = self.Node(song)
+        left, right = self._split(self._root, index)
+        self._set_root(self._merge(self._merge(left, node), right))
+        self._nodes[song] = node
+
+        # Kept in queue order; usually the song lands after the requester's others.
+        nodes = self._by_requester[self.requester(song)]
+        low, high = 0, len(nodes)
+        if nodes and self.index_of(nodes[-1]) < index:
+            low = high
+        while low < high:
+            middle = (low + high) // 2
+            if self.index_of(nodes[middle]) < index:
+                low = middle + 1
+            else:
+                high = middle
+        nodes.insert(low, node)
+
+    def append(self, song: Song):
+        self.insert(len(self), song)
+
+    def pop(self, index: int):
+        left, rest = self._split(self._root, index)
+        node, right = self._split(rest, 1)
+        if node is None:
+            self._set_root(self._merge(left, right))
+            raise IndexError('queue index out of range')
+        self._set_root(self._merge(left, right))
+
+        del self._nodes[node.song]
+        key = self.requester(node.song)
+        nodes = self._by_requester[key]
+        nodes.remove(node)
+        if not nodes:
+            del self._by_requester[key]
+        return node.song
+
+    def popleft(self):
+        return self.pop(0)
+
+    def refresh(self, song: Song):
+        # The song's track was swapped for a resolved one; fix the durations above it.
+        node = self._nodes.get(song)
+        while node is not None:
+            self._update(node)
+            node = node.parent
+
+    def clear(self):
+        self._root = None
+        self._nodes.clear()
+        self._by_requester.clear()
+
+    def rebuild(self, songs):
+        self.clear()
+        for song in songs:
+            self.append(song)
+
+    def count(self, requester_id):
+        nodes = self._by_requester.get(requester_id)
+        return len(nodes) if nodes else 0
+
+    def songs_of(self, requester_id):
+        return [node.song for node in self._by_requester.get(requester_id, ())]
+
+    def fair_index(self, requester_id):
+        # Round robin between requesters: a requester's n-th queued song
+        # goes ahead of everyone else's (n+1)-th, and never ahead of their own.
+        mine = self._by_requester.get(requester_id)
+        rounds = len(mine) if mine else 0
+        index = len(self)
+        for key, nodes in self._by_requester.items():
+            if key != requester_id and len(nodes) > rounds + 1:
+                index = min(index, self.index_of(nodes[rounds + 1]))
+        if mine:
+            index = max(index, self.index_of(mine[-1]) + 1)
+        return index
 
 
 class SongQueue(asyncio.Queue):
+    def __init__(self, record=None, wakeup=None):
+        super().__init__()
+        self._record = record
+        self._wakeup = wakeup
+        self._insert_at = None
+
+    def _init(self, maxsize):
+        self._queue = SongTree()
+
+    def _put(self, item):
+        item.queued_at = time.perf_counter()
+        if self._insert_at is None:
+            self._queue.append(item)
+            if self._record is not None:
+                self._record({'op': 'put', 'song': item.to_dict()})
+        else:
+            self._queue.insert(self._insert_at, item)
+            if self._record is not None:
+                self._record({'op': 'insert', 'index': self._insert_at, 'song': item.to_dict()})
+
+        if self._wakeup is not None:
+            self._wakeup()
+
+    def _get(self):
+        item = self._queue.popleft()
+        if self._record is not None:
+            self._record({'op': 'get'})
+        return item
+
+    def _index(self, index: int):
+        if index < 0:
+            index += len(self._queue)
+        if not 0 <= index < len(self._queue):
+            raise IndexError('queue index out of range')
+        return index
+
     def __getitem__(self, item):
         if isinstance(item, slice):
-            return list(itertools.islice(self._queue, item.start, item.stop, item.step))
+            start, stop, step = item.indices(len(self._queue))
+            if step != 1:
+                return list(self._queue)[item]
+            return self._queue.slice(start, stop)
         else:
-            return self._queue[item]
+            return self._queue.get(self._index(item))
 
     def __iter__(self):
-        return self._queue.__iter__()
+        return iter(self._queue)
 
     def __len__(self):
         return self.qsize()
 
+    @property
+    def duration(self):
+        return self._queue.duration
+
+    def starts_in(self, index: int):
+        return self._queue.elapsed_before(self._index(index))
+
+    def count(self, requester_id):
+        return self._queue.count(requester_id)
+
+    def songs_of(self, requester_id):
+        return self._queue.songs_of(requester_id)
+
+    def refresh(self, song: Song):
+        self._queue.refresh(song)
+
+    def insert(self, index: int, song: Song):
+        # Goes through put_nowait so waiting getters are woken like for put().
+        self._insert_at = min(max(index, 0), len(self._queue))
+        try:
+            self.put_nowait(song)
+        finally:
+            self._insert_at = None
+
+    def put_fair(self, song: Song):
+        self.insert(self._queue.fair_index(SongTree.requester(song)), song)
+
+    def move(self, source: int, destination: int):
+        source = self._index(source)
+        destination = self._index(destination)
+        self._queue.insert(destination, self._queue.pop(source))
+        if self._record is not None:
+            self._record({'op': 'move', 'from': source, 'to': destination})
+
     def clear(self):
+        for song in self._queue:
+            song.close()
         self._queue.clear()
+        if self._record is not None:
+            self._record({'op': 'clear'})
 
     def shuffle(self):
-        random.shuffle(self._queue)
+        # Seeded so that replaying the journal lands on the same order.
+        seed = random.getrandbits(32)
+        songs = list(self._queue)
+        random.Random(seed).shuffle(songs)
+        self._queue.rebuild(songs)
+        if self._record is not None:
+            self._record({'op': 'shuffle', 'seed': seed})
 
     def remove(self, index: int):
-        del self._queue[index]
+        index = self._index(index)
+        self._queue.pop(index).close()
+        if self._record is not None:
+            self._record({'op': 'remove', 'index': index})
+
+
+class DownloadJobs:
+    PROGRESS_INTERVAL = 3
+
+    DOWNLOAD_OPTIONS = {
+        'format': 'bestaudio/best',
+        'noplaylist': True,
+        'nocheckcertificate': True,
+        'quiet': True,
+        'no_warnings': True,
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': '198',
+        }],
+    }
+
+    def __init__(self, workers: int = 2, *, max_waiting: int = 8):
+        self.workers = workers
+        self.max_waiting = max_waiting
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='nia-download')
+        self._slots = None
+        self.waiting = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+
+    @contextlib.asynccontextmanager
+    async def download(self, url: str, *, report):
+        # Every job gets its own temp directory, removed once the caller is
+        # done with the file. `report` is awaited with each new status line.
+        loop = asyncio.get_event_loop()
+        directory = tempfile.mkdtemp(prefix='nia-sendsong-')
+        try:
+            yield await self._run(url, directory, report, loop)
+        finally:
+            await loop.run_in_executor(None, functools.partial(shutil.rmtree, directory, ignore_errors=True))
+
+    async def _run(self, url: str, directory: str, report, loop: asyncio.BaseEventLoop):
+        if self.waiting >= self.max_waiting:
+            raise YTDLError('Too many downloads are waiting already, try again in a bit')
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+
+        status = {'text': 'Waiting for a free download slot...'}
+        reporter = loop.create_task(self._report(status, report))
+        self.waiting += 1
+        started = False
+        try:
+            async with self._slots:
+                self.waiting -= 1
+                started = True
+                self.active += 1
+                status['text'] = 'Downloading...'
+                try:
+                    path = await loop.run_in_executor(self._executor, self._download, url, directory, status)
+                except Exception:
+                    self.failed += 1
+                    raise
+                finally:
+                    self.active -= 1
+        finally:
+            if not started:
+                self.waiting -= 1
+            reporter.cancel()
+
+        self.completed += 1
+        return path
+
+    def _download(self, url: str, directory: str, status: dict):
+        # Runs on a download thread; the reporter picks up status changes.
+        def hook(progress: dict):
+            if progress['status'] == 'downloading':
+                total = progress.get('total_bytes') or progress.get('total_bytes_estimate')
+                if total:
+                    status['text'] = 'Downloading... {:.0f}%'.format(
+                        100 * progress.get('downloaded_bytes', 0) / total)
+            elif progress['status'] == 'finished':
+                status['text'] = 'Converting to mp3...'
+
+        options = dict(self.DOWNLOAD_OPTIONS,
+                       outtmpl=os.path.join(directory, 'song.%(ext)s'),
+                       progress_hooks=[hook])
+        with youtube_dl.YoutubeDL(options) as ydl:
+            ydl.download([url])
+
+        return os.path.join(directory, 'song.mp3')
+
+    async def _report(self, status: dict, report):
+        shown = None
+        while True:
+            if status['text'] != shown:
+                shown = status['text']
+                try:
+                    await report(shown)
+                except discord.HTTPException:
+                    pass
+            await asyncio.sleep(self.PROGRESS_INTERVAL)
+
+
+class QueueJournal:
+    # Every guild with something queued gets a snapshot file and a log of
+    # the queue operations since that snapshot. Once a log grows past
+    # COMPACT_EVERY entries the guild is snapshotted again and its log
+    # truncated, so recovery reads at most that many lines per guild.
+    FLUSH_DELAY = 1
+    COMPACT_EVERY = 500
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='nia-journal')
+        self._pending = collections.defaultdict(list)
+        self._snapshots = {}
+        self._ops = collections.Counter()
+        self._flush_handle = None
+
+    def _path(self, guild_id: int, ext: str):
+        return os.path.join(self.directory, '{}.{}'.format(guild_id, ext))
+
+    def record(self, guild_id: int, op: dict):
+        self._pending[guild_id].append(json.dumps(op))
+        self._ops[guild_id] += 1
+        self._schedule()
+        return self._ops[guild_id] >= self.COMPACT_EVERY
+
+    def snapshot(self, guild_id: int, state: dict):
+        # Everything still pending for this guild is part of the snapshot.
+        self._pending.pop(guild_id, None)
+        self._snapshots[guild_id] = json.dumps(state)
+        self._ops[guild_id] = 0
+        self._schedule()
+
+    def drop(self, guild_id: int):
+        self._pending.pop(guild_id, None)
+        self._snapshots[guild_id] = None
+        self._ops.pop(guild_id, None)
+        self._schedule()
+
+    def _schedule(self):
+        if self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(self.FLUSH_DELAY, self._flush, loop)
+
+    def _flush(self, loop: asyncio.BaseEventLoop):
+        self._flush_handle = None
+        snapshots, self._snapshots = self._snapshots, {}
+        pending, self._pending = self._pending, collections.defaultdict(list)
+        job = loop.run_in_executor(self._executor, self._write, snapshots, pending)
+        job.add_done_callback(self._flushed)
+
+    @staticmethod
+    def _flushed(job: asyncio.Future):
+        if not job.cancelled() and job.exception() is not None:
+            print("[ERROR] COULD NOT WRITE THE QUEUE JOURNAL: {}".format(job.exception()))
+
+    def _write(self, snapshots: dict, pending: dict):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Snapshots go first: they cover every operation queued before them,
+        # while the pending lines for the same guild came after.
+        for guild_id, state in snapshots.items():
+            path = self._path(guild_id, 'json')
+            log = self._path(guild_id, 'log')
+            if state is None:
+                for stale in (path, log):
+                    if os.path.exists(stale):
+                        os.remove(stale)
+                continue
+
+            with open(path + '.tmp', 'w') as f:
+                f.write(state)
+            os.replace(path + '.tmp', path)
+            open(log, 'w').close()
+
+        for guild_id, lines in pending.items():
+            if lines:
+                with open(self._path(guild_id, 'log'), 'a') as f:
+                    f.write('\n'.join(lines) + '\n')
+
+    async def load(self, *, loop: asyncio.BaseEventLoop = None, owns=None):
+        loop = loop or asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._load_all, owns)
+
+    def _load_all(self, owns=None):
+        if not os.path.isdir(self.directory):
+            return {}
+
+        guild_ids = set()
+        for name in os.listdir(self.directory):
+            guild_id, _, ext = name.partition('.')
+            if guild_id.isdigit() and ext in ('json', 'log'):
+                guild_ids.add(int(guild_id))
+        # The directory is shared between shards; skip other shards' guilds
+        # before their journals are read at all.
+        if owns is not None:
+            guild_ids = {guild_id for guild_id in guild_ids if owns(guild_id)}
+
+        states = {}
+        for guild_id in guild_ids:
+            try:
+                state = self._load(guild_id)
+            except (OSError, ValueError, LookupError) as e:
+                print("[ERROR] COULD NOT RECOVER THE QUEUE OF GUILD {}: {}".format(guild_id, e))
+                continue
+            if state['current'] is not None or state['songs']:
+                states[guild_id] = state
+        return states
+
+    def _load(self, guild_id: int):
+        state = {'voice': None, 'current': None, 'position': 0, 'songs': []}
+        path = self._path(guild_id, 'json')
+        if os.path.exists(path):
+            with open(path) as f:
+                state.update(json.load(f))
+
+        log = self._path(guild_id, 'log')
+        if not os.path.exists(log):
+            return state
+
+        songs = state['songs']
+        with open(log) as f:
+            for line in f:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    # A torn write from the crash; nothing after it is usable.
+                    break
+
+                kind = op['op']
+                if kind == 'put':
+                    songs.append(op['song'])
+                elif kind == 'insert':
+                    songs.insert(op['index'], op['song'])
+                elif kind == 'move':
+                    songs.insert(op['to'], songs.pop(op['from']))
+                elif kind == 'get':
+                    del songs[:1]
+                elif kind == 'remove':
+                    del songs[op['index']]
+                elif kind == 'shuffle':
+                    random.Random(op['seed']).shuffle(songs)
+                elif kind == 'clear':
+                    songs.clear()
+                elif kind == 'current':
+                    state['current'] = op['song']
+                    state['position'] = op.get('at', 0)
+                elif kind == 'position':
+                    state['position'] = op['at']
+                elif kind == 'voice':
+                    state['voice'] = op['channel']
+        return state
+
+    def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        snapshots, self._snapshots = self._snapshots, {}
+        pending, self._pending = self._pending, collections.defaultdict(list)
+        self._executor.submit(self._write, snapshots, pending).result()
+        self._executor.shutdown(wait=True)
 
 
 class VoiceState:
-    def __init__(self, bot: commands.Bot, ctx: commands.Context):
+    # How many queued songs get looked up ahead of time.
+    RESOLVE_AHEAD = 2
+    # Decode the opening of the next song early so the handoff is close to
+    # gapless. PREWARM_FRAMES is in 20 ms frames.
+    PREWARM = True
+    PREWARM_FRAMES = 25
+    # Gaps between songs longer than this (in seconds) get logged.
+    GAP_BUDGET = 0.25
+    # Send Opus from ffmpeg straight to Discord instead of decoding to PCM;
+    # Opus streams then play at their own level. This is the default for new guilds; `nia opus`
+    # flips it per guild.
+    OPUS_PASSTHROUGH = False
+    # Interleave songs from different requesters instead of queueing them in
+    # order of arrival; `nia fair` flips it per guild.
+    FAIR_QUEUE = False
+    # Most songs one member may have queued at once; None for no limit.
+    MAX_PER_REQUESTER = None
+    # Seconds each song fades into the next; 0 plays them back to back.
+    # `nia crossfade` sets it per guild.
+    CROSSFADE = 0
+
+    def __init__(self, bot: commands.Bot, guild: discord.Guild, journal: QueueJournal = None,
+                 transport: VoiceTransport = None):
         self.bot = bot
-        self._ctx = ctx
+        self.guild = guild
+        self.journal = journal
+        self.transport = transport or DiscordTransport()
 
         self.current = None
-        self.voice = None
+        self._voice = None
+        self.connected = asyncio.Event()
         self.next = asyncio.Event()
-        self.songs = SongQueue()
+        self.songs = SongQueue(record=self.record, wakeup=self.wake)
+        self.pages = QueuePages(self.songs)
 
         self._loop = False
         self._volume = 0.5
+        self.opus = self.OPUS_PASSTHROUGH
+        self.fair = self.FAIR_QUEUE
+        self.crossfade = self.CROSSFADE
         self.skip_votes = set()
 
-        self.audio_player = bot.loop.create_task(self.audio_player_task())
+        self._prefetcher = None
+        self._song_finished = None
+        self._last_finished = 0.0
+        self._started_at = None
+        self._resume_at = 0
+        self.gaps = collections.deque(maxlen=100)
 
-    def __del__(self):
-        self.audio_player.cancel()
+        # Only runs while there is a voice connection and something to play;
+        # `idle_since` is when it last stopped, for Music's idle reaper.
+        self.audio_player = None
+        self.idle_since = time.monotonic()
 
     @property
     def loop(self):
@@ -211,6 +2765,7 @@ class VoiceState:
     @loop.setter
     def loop(self, value: bool):
         self._loop = value
+        self.chain()
 
     @property
     def volume(self):
@@ -220,37 +2775,191 @@ class VoiceState:
     def volume(self, value: float):
         self._volume = value
 
+    @property
+    def voice(self):
+        return self._voice
+
+    @voice.setter
+    def voice(self, value: discord.VoiceClient):
+        self._voice = value
+        if value is None:
+            self.connected.clear()
+        else:
+            self.connected.set()
+        self.record({'op': 'voice', 'channel': value.channel.id if value else None})
+        self.wake()
+
     @property
     def is_playing(self):
         return self.voice and self.current
 
+    @property
+    def position(self):
+        if self._started_at is None:
+            return 0
+        return time.time() - self._started_at
+
+    def record(self, op: dict):
+        self.pages.changed(op)
+        self.chain()
+        if self.journal is None:
+            return
+
+        if self.journal.record(self.guild.id, op):
+            self.save()
+
+    def save(self):
+        if self.journal is None:
+            return
+
+        self.journal.snapshot(self.guild.id, {
+            'voice': self.voice.channel.id if self.voice else None,
+            'current': self.current.to_dict() if self.current else None,
+            'position': self.position,
+            'songs': [song.to_dict() for song in self.songs],
+        })
+
+    def chain(self):
+        # Points the playing source at whatever is next in the queue, so a
+        # crossfade always fades into the song that will actually follow.
+        current = self.current.source if self.current is not None else None
+        if not isinstance(current, YTDLSource):
+            return
+
+        following = self.songs[0].source if len(self.songs) > 0 else None
+        if self.crossfade and not self.loop and isinstance(following, YTDLSource):
+            current.fade_into(following, int(self.crossfade * PCMEngine.FRAMES_PER_SECOND))
+        else:
+            current.fade_into(None)
+
+    def enqueue(self, song: Song):
+        if self.MAX_PER_REQUESTER is not None and self.songs.count(song.requester.id) >= self.MAX_PER_REQUESTER:
+            return False
+
+        if self.fair:
+            self.songs.put_fair(song)
+        else:
+            self.songs.put_nowait(song)
+        return True
+
+    def touch(self):
+        if self.idle_since is not None:
+            self.idle_since = time.monotonic()
+
+    def wake(self):
+        if self.audio_player is None and self.voice is not None and len(self.songs) > 0:
+            self.idle_since = None
+            self.audio_player = self.bot.loop.create_task(self.audio_player_task())
+
     async def audio_player_task(self):
+        try:
+            await self._play_songs()
+        finally:
+            self.audio_player = None
+            self.idle_since = time.monotonic()
+
+    async def _play_songs(self):
         while True:
             self.next.clear()
 
             if not self.loop:
-                # Try to get the next song within 3 minutes.
-                # If no song will be added to the queue in time,
-                # the player will disconnect due to performance
-                # reasons.
-                try:
-                    async with timeout(180):  # 3 minutes
-                        self.current = await self.songs.get()
-                except asyncio.TimeoutError:
-                    self.bot.loop.create_task(self.stop())
+                if len(self.songs) == 0:
+                    # Queueing another song starts a new player task.
+                    if self.current is not None:
+                        self.current = None
+                        self._started_at = None
+                        self.record({'op': 'current', 'song': None, 'at': 0})
                     return
 
-            self.current.source.volume = self._volume
-            self.voice.play(self.current.source, after=self.play_next_song)
-            await self.current.source.channel.send(embed=self.current.create_embed())
+                song = self.songs.get_nowait()
+                try:
+                    await song.revalidate(self.bot.loop)
+                except Exception as e:
+                    song.close()
+                    await song.channel.send('Skipping {}: {}'.format(str(song.track), str(e)))
+                    continue
+
+                self.current = song
+
+            # Songs restored from the journal wait here until we're back in voice.
+            await self.connected.wait()
+
+            start, self._resume_at = self._resume_at, 0
+            if start:
+                self.current.close()
+            try:
+                source = self.current.open(self.transport, self._volume, start=start, opus=self.opus)
+                await source.ready()
+            except Exception as e:
+                self.current.close()
+                await self.current.channel.send('Skipping {}: {}'.format(str(self.current.track), str(e)))
+                # Looping a song that won't open would only fail again.
+                self.loop = False
+                continue
+
+            source.volume = self._volume
+            self.voice.play(source, after=self.play_next_song)
+            if self.current.queued_at is not None:
+                # Time spent waiting behind other songs doesn't count.
+                metrics.observe('nia_queue_to_audio_seconds',
+                                time.perf_counter() - max(self.current.queued_at, self._last_finished))
+                self.current.queued_at = None
+            self._started_at = time.time() - start
+            self.record({'op': 'current', 'song': self.current.to_dict(), 'at': start})
+            YTDLSource.audio_cache.played(self.current.track, self.bot.loop)
+            self.record_gap()
+            self.resolve_ahead()
+            await self.current.channel.send(embed=self.current.create_embed())
 
             await self.next.wait()
+            # The voice client cleans up a finished source; looping opens a new one.
+            self.current.source = None
+
+            track = self.current.track
+            if isinstance(source, YTDLSource) and track.loudness is None and source.loudness is not None:
+                track.loudness = source.loudness
+                YTDLSource.index.put(['url:' + track.url], track)
+
+    def resolve_ahead(self):
+        if self._prefetcher is None or self._prefetcher.done():
+            self._prefetcher = self.bot.loop.create_task(self.prefetch_task())
+
+    async def prefetch_task(self):
+        for index, song in enumerate(self.songs[:self.RESOLVE_AHEAD]):
+            try:
+                await song.revalidate(self.bot.loop)
+                self.songs.refresh(song)
+                self.pages.invalidate(index)
+                if index == 0 and self.PREWARM:
+                    warming = song.open(self.transport, self._volume, opus=self.opus).prewarm(self.PREWARM_FRAMES, loop=self.bot.loop)
+                    if warming is not None:
+                        await warming
+                    self.chain()
+            except Exception as e:
+                # The player retries the lookup and reports it once the song is up.
+                print("[ERROR] PREFETCH FAILED FOR '{}': {}".format(song.track.title, e))
+
+    def record_gap(self):
+        if self._song_finished is None:
+            return
+
+        gap = time.perf_counter() - self._song_finished
+        self._song_finished = None
+        self.gaps.append(gap)
+        metrics.observe('nia_track_gap_seconds', gap)
+        if gap > self.GAP_BUDGET:
+            print("[WARN] {:.0f} MS OF SILENCE BETWEEN SONGS".format(gap * 1000))
 
     def play_next_song(self, error=None):
         if error:
             raise VoiceError(str(error))
 
-        self.next.set()
+        self._last_finished = time.perf_counter()
+        # Only a handoff to a waiting song counts as a gap, not idle time.
+        if self.loop or len(self.songs) > 0:
+            self._song_finished = self._last_finished
+        # Called on the voice client's player thread.
+        self.bot.loop.call_soon_threadsafe(self.next.set)
 
     def skip(self):
         self.skip_votes.clear()
@@ -259,27 +2968,299 @@ class VoiceState:
             self.voice.stop()
 
     async def stop(self):
+        if self.audio_player is not None:
+            self.audio_player.cancel()
         self.songs.clear()
 
         if self.voice:
             await self.voice.disconnect()
             self.voice = None
 
+        if self.current is not None:
+            self.current.close()
+        self.current = None
+        self._started_at = None
+        if self.journal is not None:
+            self.journal.drop(self.guild.id)
+
+
+class MessageCleanup:
+    # Discord bulk-deletes up to 100 messages per call, but only ones younger
+    # than 14 days (a little margin here for clock skew). Older messages go
+    # one by one, a few at a time; discord.py waits out the route's rate limit.
+    BULK_SIZE = 100
+    BULK_MAX_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=5)
+    SINGLE_CONCURRENCY = 3
+    PROGRESS_INTERVAL = 3
+
+    def __init__(self, channel: discord.TextChannel, status: discord.Message):
+        self.channel = channel
+        self.status = status
+        self.found = 0
+        self.deleted = 0
+        self.failed = 0
+        self.forbidden = False
+        self._reported = time.monotonic()
+
+    async def run(self, limit: int):
+        cutoff = datetime.datetime.utcnow() - self.BULK_MAX_AGE
+        recent, old = [], []
+        async for message in self.channel.history(limit=limit, before=self.status):
+            self.found += 1
+            if message.created_at > cutoff:
+                recent.append(message)
+                if len(recent) == self.BULK_SIZE:
+                    await self._bulk(recent)
+                    recent = []
+            else:
+                old.append(message)
+            if self.forbidden:
+                return
+
+        if recent:
+            await self._bulk(recent)
+        if old and not self.forbidden:
+            await self._singles(old)
+
+    async def _bulk(self, messages):
+        try:
+            await self.channel.delete_messages(messages)
+        except discord.Forbidden:
+            self.forbidden = True
+            self.failed += len(messages)
+        except discord.HTTPException as e:
+            # Most likely some were already gone; fall back to deleting one by one.
+            print("[WARN] BULK DELETE FAILED, DELETING ONE BY ONE: {}".format(e))
+            await self._singles(messages)
+        else:
+            self.deleted += len(messages)
+        await self._progress()
+
+    async def _singles(self, messages):
+        limit = asyncio.Semaphore(self.SINGLE_CONCURRENCY)
+
+        async def delete(message: discord.Message):
+            async with limit:
+                if self.forbidden:
+                    self.failed += 1
+                    return
+                try:
+                    await message.delete()
+                except discord.NotFound:
+                    pass
+                except discord.Forbidden:
+                    self.forbidden = True
+                    self.failed += 1
+                except discord.HTTPException as e:
+                    print("[ERROR] COULD NOT DELETE MESSAGE {}: {}".format(message.id, e))
+                    self.failed += 1
+                else:
+                    self.deleted += 1
+                await self._progress()
+
+        await asyncio.gather(*(delete(message) for message in messages))
+
+    async def _progress(self):
+        now = time.monotonic()
+        if now - self._reported < self.PROGRESS_INTERVAL:
+            return
+        self._reported = now
+        try:
+            await self.status.edit(content='Deleting... {} of {} done'.format(self.deleted, self.found))
+        except discord.HTTPException:
+            pass
+
+    def summary(self):
+        text = 'Deleted {} of {} messages from current channel'.format(self.deleted, self.found)
+        if self.forbidden:
+            text += ". I'm missing the Manage Messages permission for the rest"
+        elif self.failed:
+            text += ' ({} could not be deleted)'.format(self.failed)
+        return text
+
 
 class Music(commands.Cog):
-    def __init__(self, bot: commands.Bot):
+    # Rejoin the saved voice channels after a restart and pick the current
+    # song back up close to where it stopped.
+    REJOIN = True
+    # How often (in seconds) the playback position is written to the journal.
+    POSITION_INTERVAL = 15
+    # `nia queue` reactions turn pages for this many seconds after the last turn.
+    PAGE_EMOJI = ('◀', '▶')
+    PAGE_TIMEOUT = 60
+    # Guilds with nothing playing or queued are disconnected and forgotten
+    # after IDLE_TIMEOUT seconds, checked every REAP_INTERVAL seconds.
+    IDLE_TIMEOUT = 180
+    REAP_INTERVAL = 30
+    # Prometheus text exposition on this local port; None turns it off.
+    METRICS_HOST = '127.0.0.1'
+    METRICS_PORT = 9464
+    # Log the loop thread's stack whenever the event loop is held for longer
+    # than this many seconds. None leaves the watchdog off.
+    WATCHDOG_THRESHOLD = None
+    # Also report every blocking call made from a coroutine. Slow; only for
+    # tracking a stutter down.
+    LOOP_DEBUG = False
+
+    def __init__(self, bot: commands.Bot, transport: VoiceTransport = None):
         self.bot = bot
+        self.transport = transport or DiscordTransport()
         self.voice_states = {}
+        self.journal = QueueJournal('queues')
+        self.downloads = DownloadJobs(workers=2)
+        self._restored = False
+        self._positions = bot.loop.create_task(self.position_task())
+        self._reaper = bot.loop.create_task(self.reap_task())
+        self._throughput = bot.loop.create_task(YTDLSource.throughput.run(loop=bot.loop))
+        self.lag = loop_monitor
+        self._lag = bot.loop.create_task(self.lag.run())
+        if self.WATCHDOG_THRESHOLD is not None:
+            self.lag.watch(self.WATCHDOG_THRESHOLD)
+        if self.LOOP_DEBUG:
+            self.lag.debug(bot.loop, self.WATCHDOG_THRESHOLD or 0.1)
+        self._metrics_server = None
+        self.register_metrics()
+        if self.METRICS_PORT is not None:
+            bot.loop.create_task(self.serve_metrics())
+        self._rescan = None
+        self._search_load = None
+
+    def register_metrics(self):
+        scheduler = YTDLSource.scheduler
+        metrics.gauge('nia_extraction_backlog', 'Extractions waiting for a worker.',
+                      lambda: scheduler.backlog)
+        metrics.gauge('nia_extraction_in_flight', 'Extractions running right now.',
+                      lambda: scheduler.in_flight)
+        metrics.gauge('nia_extraction_rejected', 'Extractions turned away because the backlog was full.',
+                      lambda: scheduler.rejected)
+        metrics.gauge('nia_extraction_cache_hits', 'Lookups answered from the in-memory cache.',
+                      lambda: YTDLSource.cache.hits)
+        metrics.gauge('nia_extraction_cache_misses', 'Lookups the in-memory cache could not answer.',
+                      lambda: YTDLSource.cache.misses)
+        metrics.gauge('nia_audio_cache_bytes', 'Size of the local audio cache.',
+                      lambda: YTDLSource.audio_cache.size)
+        metrics.gauge('nia_search_index_tracks', 'Tracks the local search index knows.',
+                      lambda: len(YTDLSource.search_index))
+        metrics.gauge('nia_search_index_hits', 'Searches resolved from the local search index.',
+                      lambda: YTDLSource.search_index.hits)
+        metrics.gauge('nia_ffmpeg_processes', 'Live ffmpeg processes.',
+                      lambda: Prewarmable.processes)
+        metrics.gauge('nia_broadcasts', 'Tracks decoded once for several guilds.',
+                      lambda: len(Broadcast.live))
+        metrics.gauge('nia_broadcast_listeners', 'Guilds listening to a broadcast.',
+                      lambda: sum(broadcast.listeners for broadcast in list(Broadcast.live.values())))
+        metrics.gauge('nia_streamed_bytes', 'Bytes ffmpeg has received over the network.',
+                      lambda: YTDLSource.throughput.streamed)
+        metrics.gauge('nia_voice_states', 'Guilds with a voice state.',
+                      lambda: len(self.voice_states))
+        metrics.gauge('nia_queue_length', 'Songs waiting in each guild\'s queue.',
+                      lambda: {(('guild', str(guild_id)),): len(state.songs)
+                               for guild_id, state in self.voice_states.items()})
+
+    async def serve_metrics(self):
+        try:
+            self._metrics_server = await metrics.serve(self.METRICS_HOST, self.METRICS_PORT)
+        except OSError as e:
+            print("[ERROR] COULD NOT SERVE METRICS ON PORT {}: {}".format(self.METRICS_PORT, e))
+        else:
+            print("[INFO] SERVING METRICS ON {}:{}".format(self.METRICS_HOST, self.METRICS_PORT))
 
     def get_voice_state(self, ctx: commands.Context):
         state = self.voice_states.get(ctx.guild.id)
         if not state:
-            state = VoiceState(self.bot, ctx)
+            state = VoiceState(self.bot, ctx.guild, self.journal, self.transport)
             self.voice_states[ctx.guild.id] = state
 
         return state
 
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if self._restored:
+            return
+        self._restored = True
+
+        await YTDLSource.audio_cache.load(loop=self.bot.loop)
+        if YTDLSource.audio_cache.rescan:
+            self._rescan = self.bot.loop.create_task(YTDLSource.audio_cache.refresh(loop=self.bot.loop))
+
+        # The journal directory is shared; other shards restore their own guilds.
+        saved = await self.journal.load(loop=self.bot.loop, owns=self.owns)
+        for guild_id, state in saved.items():
+            try:
+                await self.restore(guild_id, state)
+            except Exception as e:
+                print("[ERROR] COULD NOT RESTORE THE QUEUE OF GUILD {}: {}".format(guild_id, e))
+        if saved:
+            print("[INFO] RESTORED {} QUEUES".format(len(saved)))
+
+        # Searches go to the extractor until this is done, so it needn't hold up recovery.
+        self._search_load = self.bot.loop.create_task(
+            YTDLSource.search_index.load(YTDLSource.index, loop=self.bot.loop))
+
+    def owns(self, guild_id: int):
+        if self.bot.shard_count is None:
+            return True
+        return (guild_id >> 22) % self.bot.shard_count == (self.bot.shard_id or 0)
+
+    async def restore(self, guild_id: int, saved: dict):
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            self.journal.drop(guild_id)
+            return
+
+        # Rebuilt without the journal attached, then written out in one snapshot.
+        state = VoiceState(self.bot, guild, transport=self.transport)
+        songs = [Song.from_dict(data, guild) for data in saved['songs']]
+        if saved['current'] is not None:
+            songs.insert(0, Song.from_dict(saved['current'], guild))
+            if self.REJOIN:
+                state._resume_at = saved['position']
+        for song in songs:
+            state.songs.put_nowait(song)
+
+        state.journal = self.journal
+        state.save()
+        self.voice_states[guild_id] = state
+
+        channel = guild.get_channel(saved['voice']) if saved['voice'] else None
+        if self.REJOIN and channel is not None:
+            state.voice = await self.transport.connect(channel)
+
+    async def position_task(self):
+        await self.bot.wait_until_ready()
+        while True:
+            await asyncio.sleep(self.POSITION_INTERVAL)
+            for state in self.voice_states.values():
+                if state.is_playing:
+                    state.record({'op': 'position', 'at': state.position})
+
+    async def reap_task(self):
+        while True:
+            await asyncio.sleep(self.REAP_INTERVAL)
+            now = time.monotonic()
+            for guild_id, state in list(self.voice_states.items()):
+                # Songs waiting for someone to rejoin voice aren't idle.
+                if state.idle_since is None or len(state.songs) > 0:
+                    continue
+                # `nia leave` may have dropped it while an earlier guild was stopping.
+                if now - state.idle_since > self.IDLE_TIMEOUT and self.voice_states.get(guild_id) is state:
+                    del self.voice_states[guild_id]
+                    try:
+                        await state.stop()
+                    except Exception as e:
+                        print("[ERROR] COULD NOT LEAVE IDLE GUILD {}: {}".format(guild_id, e))
+
     def cog_unload(self):
+        self._positions.cancel()
+        self._reaper.cancel()
+        self._throughput.cancel()
+        self._lag.cancel()
+        if self._rescan is not None:
+            self._rescan.cancel()
+        if self._search_load is not None:
+            self._search_load.cancel()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
         for state in self.voice_states.values():
             self.bot.loop.create_task(state.stop())
 
@@ -292,6 +3273,7 @@ class Music(commands.Cog):
 
     async def cog_before_invoke(self, ctx: commands.Context):
         ctx.voice_state = self.get_voice_state(ctx)
+        ctx.voice_state.touch()
 
     async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
         await ctx.send('An error occurred: {}'.format(str(error)))
@@ -305,7 +3287,7 @@ class Music(commands.Cog):
             await ctx.voice_state.voice.move_to(destination)
             return
 
-        ctx.voice_state.voice = await destination.connect()
+        ctx.voice_state.voice = await self.transport.connect(destination)
 
     @commands.command(name='summon')
     @commands.has_permissions(manage_guild=True)
@@ -323,7 +3305,7 @@ class Music(commands.Cog):
             await ctx.voice_state.voice.move_to(destination)
             return
 
-        ctx.voice_state.voice = await destination.connect()
+        ctx.voice_state.voice = await self.transport.connect(destination)
 
     @commands.command(name='leave', aliases=['disconnect'])
     @commands.has_permissions(manage_guild=True)
@@ -334,11 +3316,14 @@ class Music(commands.Cog):
             return await ctx.send('Not connected to any voice channel.')
 
         await ctx.voice_state.stop()
-        del self.voice_states[ctx.guild.id]
+        # The idle reaper may have dropped the guild while we disconnected.
+        self.voice_states.pop(ctx.guild.id, None)
 
     @commands.command(name='now', aliases=['current', 'playing'])
     async def _now(self, ctx: commands.Context):
         """Displays the currently playing song."""
+        if ctx.voice_state.current is None:
+            return await ctx.send('Hey, I don\'t think i\'m playing anything')
         await ctx.send(embed=ctx.voice_state.current.create_embed())
 
     @commands.command(name='pause')
@@ -382,33 +3367,39 @@ class Music(commands.Cog):
     async def _download(self, ctx: commands.Context):
         """Send the currently playing music."""
         print("[CONSOLE] ATTEMPTING TO DOWNLOAD A MUSIC")
-        await ctx.send("Okay... Preparing to send " + ctx.voice_state.current.currentPlayerURL()[0])
-        try:
-            isFile = os.path.isfile("song.mp3")
-            if isFile:
-                os.remove("song.mp3")
-                print("[INFO] USER REQUESTED DELETE COMMAND COMPLETE")
-        except PermissionError:
-            print("[ERROR] AN ERROR OCCURRED WHILE DELEING A FILE. FILE IS BEING USED")
+        current = ctx.voice_state.current
+        if current is None:
+            return await ctx.send('Hey, I don\'t think i\'m playing anything')
+
+        title, url = current.currentPlayerURL()
+        await ctx.send("Okay... Preparing to send " + title)
+        cached = YTDLSource.audio_cache.lookup(current.track)
+        if cached is not None:
+            return await ctx.send(file=discord.File(cached))
+
+        status = await ctx.send("Ill let you know once the download is complete")
         try:
-            await ctx.send("Ill let you know once the download is complete")
-            try:
-                with youtube_dl.YoutubeDL({'format': 'bestaudio/best','outtmpl': 'song.mp3','postprocessors': [{'key': 'FFmpegExtractAudio','preferredcodec': 'mp3','preferredquality': '198',}]}) as ydl:
-                    ydl.download([ctx.voice_state.current.currentPlayerURL()[1]])
-                await ctx.send("Download Complete. Sending you the song file")
-                await ctx.send(file=discord.File(r'./song.mp3'))
-                print("[CONSOLE] A FILE DOWNLOAD WAS COMEPLETED")
-            except:
-                print("[ERROR] UNKNOWN ERROR OCCURRED WHILE DOWNLOADING CONTENT FROM '{}'".format(ctx.voice_state.current.currentPlayerURL()[1]))
-        except:
+            async with self.downloads.download(url, report=lambda text: status.edit(content=text)) as path:
+                await status.edit(content="Download Complete. Sending you the song file")
+                await ctx.send(file=discord.File(path, filename='{}.mp3'.format(
+                    re.sub(r'[^\w\- ]', '', title).strip() or 'song')))
+            print("[CONSOLE] A FILE DOWNLOAD WAS COMEPLETED")
+        except YTDLError as e:
+            await ctx.send('Opps.. {}'.format(str(e)))
+        except Exception as e:
+            print("[ERROR] UNKNOWN ERROR OCCURRED WHILE DOWNLOADING CONTENT FROM '{}': {}".format(url, e))
             await ctx.send("Opps! I screwed up from my end! Sorry... I dont think I can send that song")
 
     @commands.command(name='shutdown')
     @commands.has_permissions(manage_guild=True)
     async def _shutdown(self, ctx: commands.Context):
         """Shutdown Nia [You will need Peter to start this once you do this]."""
-        ctx.voice_state.songs.clear()
         await ctx.send("Shutting Down")
+        # Queues are kept so they come back on the next start.
+        for state in self.voice_states.values():
+            state.save()
+        YTDLSource.index.close()
+        self.journal.close()
         exit()
 
     @commands.command(name='skip')
@@ -441,27 +3432,43 @@ class Music(commands.Cog):
     @commands.command(name='queue')
     async def _queue(self, ctx: commands.Context, *, page: int = 1):
         """Shows the player's queue.
-        You can optionally specify the page to show. Each page contains 10 elements.
+        You can optionally specify the page to show, and flip through the rest with the reactions.
         """
 
         if len(ctx.voice_state.songs) == 0:
             return await ctx.send('There\' nothing in the queue list.')
 
-        items_per_page = 10
-        pages = math.ceil(len(ctx.voice_state.songs) / items_per_page)
+        pages = ctx.voice_state.pages
+        page = min(max(page, 1), pages.count)
+        message = await ctx.send(embed=pages.embed(page))
+        if pages.count > 1:
+            await self.paginate(ctx, message, page)
 
-        start = (page - 1) * items_per_page
-        end = start + items_per_page
+    async def paginate(self, ctx: commands.Context, message: discord.Message, page: int):
+        for emoji in self.PAGE_EMOJI:
+            await message.add_reaction(emoji)
 
-        queue = ''
-        await ctx.send("Okay... This is the current queue list")
-        for i, song in enumerate(ctx.voice_state.songs[start:end], start=start):
-            queue += '`{0}.` [**{1.source.title}**]({1.source.url})\n'.format(
-                i + 1, song)
+        def check(reaction: discord.Reaction, user: discord.User):
+            return (reaction.message.id == message.id and not user.bot
+                    and str(reaction.emoji) in self.PAGE_EMOJI)
 
-        embed = (discord.Embed(description='**{} tracks:**\n\n{}'.format(len(ctx.voice_state.songs), queue))
-                 .set_footer(text='Viewing page {}/{}'.format(page, pages)))
-        await ctx.send(embed=embed)
+        while True:
+            # Adding and removing a reaction both turn the page, so nobody
+            # has to take theirs off and we don't need manage_messages.
+            waits = [self.bot.loop.create_task(self.bot.wait_for(event, check=check))
+                     for event in ('reaction_add', 'reaction_remove')]
+            done, pending = await asyncio.wait(
+                waits, timeout=self.PAGE_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+            for wait in pending:
+                wait.cancel()
+            if not done:
+                return
+
+            reaction, _ = done.pop().result()
+            pages = ctx.voice_state.pages
+            step = -1 if str(reaction.emoji) == self.PAGE_EMOJI[0] else 1
+            page = (page - 1 + step) % pages.count + 1
+            await message.edit(embed=pages.embed(page))
 
     @commands.command(name='shuffle')
     async def _shuffle(self, ctx: commands.Context):
@@ -485,6 +3492,46 @@ class Music(commands.Cog):
         await ctx.message.add_reaction('✅')
         return await ctx.send('Okay... Dequeue operation done.. [TOP = TOP + 1]😗')
 
+    @commands.command(name='move')
+    async def _move(self, ctx: commands.Context, source: int, destination: int):
+        """Moves a song in the queue to another position."""
+
+        if len(ctx.voice_state.songs) == 0:
+            return await ctx.send('There\' nothing in the queue list.')
+
+        ctx.voice_state.songs.move(source - 1, destination - 1)
+        await ctx.message.add_reaction('✅')
+
+    @commands.command(name='fair')
+    @commands.has_permissions(manage_guild=True)
+    async def _fair(self, ctx: commands.Context):
+        """Toggle taking turns between requesters when songs are queued"""
+        ctx.voice_state.fair = not ctx.voice_state.fair
+        await ctx.send('Taking turns is now {}'.format('on' if ctx.voice_state.fair else 'off'))
+
+    @commands.command(name='broadcast')
+    @commands.has_permissions(manage_guild=True)
+    async def _broadcast(self, ctx: commands.Context, *, channel: str = None):
+        """Share playback live with every server tuned into the same channel name, no name to leave"""
+        if channel is None:
+            ctx.voice_state.transport = self.transport
+            return await ctx.send('Not sharing playback anymore')
+
+        ctx.voice_state.transport = BroadcastTransport(channel.lower(), self.transport)
+        await ctx.send('Songs that are already playing on `{}` will be joined live from the next one'.format(
+            discord.utils.escape_markdown(channel)))
+
+    @commands.command(name='crossfade')
+    @commands.has_permissions(manage_guild=True)
+    async def _crossfade(self, ctx: commands.Context, seconds: int = 0):
+        """Fade each song into the next over n seconds, 0 turns it off"""
+        if not 0 <= seconds <= 12:
+            return await ctx.send('Crossfade has to be between 0 and 12 seconds.')
+
+        ctx.voice_state.crossfade = seconds
+        ctx.voice_state.chain()
+        await ctx.send('Crossfade is now {}'.format('{}s'.format(seconds) if seconds else 'off'))
+
     @commands.command(name='thanks')
     async def _loop(self, ctx: commands.Context):
         """Just a token of appreciation"""
@@ -494,26 +3541,39 @@ class Music(commands.Cog):
     async def deleteText(self, ctx: commands.Context, *, number: str):
         """Delete n number of message using nia clear-msg <int>"""
         number = int(number) #Converting the amount of messages to delete to an integer
-        async for x in ctx.history(limit = number):
-            # print(x.id)
-            try:
-                await x.delete()
-            except:
-                print("[CONSOLE] MISSING PERMISSION")
-        await ctx.send('Deleted ' + str(number) + " of messages from current channel")
+        status = await ctx.send('Deleting {} messages...'.format(number))
+        cleanup = MessageCleanup(ctx.channel, status)
+        await cleanup.run(number)
+        await status.edit(content=cleanup.summary())
         
         
     @commands.command(name='load')
     async def loadCall(self, ctx: commands.Context):
         """Show System Stats related to server performance"""
-        await ctx.send("Getting Stats. Starting Performance Monitor...")
+        monitor = YTDLSource.throughput
         embed = discord.Embed(
             title="Nia MusicBot",
             description="All Systems Operational",
             color=discord.Color.blue())
-        embed.add_field(name='Download', value=str(round(speedtest.Speedtest().download()/102400, 2)) + ' MB')
-        embed.add_field(name='Upload', value=str(round(speedtest.Speedtest().upload()/102400, 2)) + ' MB')
-        embed.set_footer(text="Last Error: SOCKET CONNECTION FAILURE TO A LIVE SERVER (ERROR 403)")
+
+        result = monitor.result
+        if result is None:
+            monitor.probe(loop=self.bot.loop)
+            embed.add_field(name='Download', value='Measuring...')
+            embed.add_field(name='Upload', value='Measuring...')
+        else:
+            embed.add_field(name='Download', value='{:.2f} Mbps'.format(result['download'] / 1000000))
+            embed.add_field(name='Upload', value='{:.2f} Mbps'.format(result['upload'] / 1000000))
+            embed.add_field(name='Ping', value='{:.0f} ms'.format(result['ping']))
+        embed.add_field(name='Streaming', value=monitor.megabits(monitor.live_rate))
+
+        if result is not None:
+            embed.set_footer(text="Measured {:.0f} minutes ago against {}".format(
+                (time.time() - result['measured_at']) / 60, result['server']))
+        elif monitor.error is not None:
+            embed.set_footer(text="Last Error: {}".format(monitor.error[1]))
+        else:
+            embed.set_footer(text="Check back in a minute for the speed test results")
 
         return await ctx.send(embed=embed)
     
@@ -528,20 +3588,48 @@ class Music(commands.Cog):
         await ctx.send('Ayy Ayy. Captain!')
         await ctx.message.add_reaction('✅')
 
+    @commands.command(name='opus')
+    @commands.has_permissions(manage_guild=True)
+    async def _opus(self, ctx: commands.Context):
+        """Toggle Opus passthrough, which is lighter on the server but ignores volume on Opus streams. Takes effect from the next song"""
+        ctx.voice_state.opus = not ctx.voice_state.opus
+        await ctx.send('Opus passthrough is now {}{}'.format(
+            'on' if ctx.voice_state.opus else 'off',
+            ', Opus streams play at their own volume and volume changes apply from the next song'
+            if ctx.voice_state.opus else ''))
+
     @commands.command(name='state')
     async def _state(self, ctx: commands.Context):
         """Show System Stats related to application performance"""
+        def milliseconds(name, q=0.95, **labels):
+            value = metrics.quantile(name, q, **labels)
+            if value is None:
+                return 'No data yet'
+            if value == float('inf'):
+                return 'Over {:.0f} s'.format(Histogram.BUCKETS[-1])
+            return '≤ {:.0f} ms'.format(value * 1000)
+
+        scheduler = YTDLSource.scheduler.stats()
+        playing = sum(1 for state in self.voice_states.values() if state.is_playing)
+        queued = sum(len(state.songs) for state in self.voice_states.values())
+
         embed = discord.Embed(
             title="Nia MusicBot",
-            description="All Systems Operational",
+            description="All Systems Operational" if self.lag.lag < 0.1 else "Running behind",
             color=discord.Color.blue())
         embed.add_field(name='Codename', value='mus.io')
         embed.add_field(name='Version', value='v1.05')
-        embed.add_field(name='Server', value='Raspberry Pi 4B')
-        embed.add_field(
-            name='State', value='Multiple services down')
-        embed.add_field(name='Audio Playback', value='198kbps')
-        embed.add_field(name='Audio Profile', value='Best Available Audio')
+        embed.add_field(name='Server', value='{} ({})'.format(platform.node(), platform.machine()))
+        embed.add_field(name='Playing', value='{} guilds, {} songs queued'.format(playing, queued))
+        embed.add_field(name='Streaming', value=ThroughputMonitor.megabits(YTDLSource.throughput.live_rate))
+        embed.add_field(name='Audio Profile', value='Opus passthrough' if ctx.voice_state.opus else 'PCM')
+        embed.add_field(name='Lookup p95', value=milliseconds('nia_extraction_seconds', stage='process'))
+        embed.add_field(name='Queue to audio p95', value=milliseconds('nia_queue_to_audio_seconds'))
+        embed.add_field(name='Gap between songs p95', value=milliseconds('nia_track_gap_seconds'))
+        embed.add_field(name='Event loop lag', value='{:.0f} ms'.format(self.lag.lag * 1000))
+        embed.add_field(name='Lookup queue', value='{} waiting, {} running, {} rejected'.format(
+            scheduler['backlog'], scheduler['in_flight'], scheduler['rejected']))
+        embed.add_field(name='ffmpeg processes', value=str(Prewarmable.processes))
         embed.set_footer(
             text="Owned and managed by Peter K Joseph. Thanks for using me :)")
 
@@ -556,18 +3644,67 @@ class Music(commands.Cog):
 
         async with ctx.typing():
             try:
-                source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop)
-                await bot.change_presence(activity=discord.Streaming(name=str(source.title), url=str(source.url)))
+                track = await YTDLSource.resolve(search, loop=self.bot.loop, guild_id=ctx.guild.id)
+                await self.bot.change_presence(activity=discord.Streaming(name=str(track.title), url=str(track.url)))
             except YTDLError as e:
                 await ctx.send('Opps.. An internal error occurred while doing that: {}'.format(str(e)))
             else:
-                song = Song(source)
+                song = Song(track, ctx.author, ctx.channel)
+
+                if not ctx.voice_state.enqueue(song):
+                    return await ctx.send('You already have {} songs in the queue'.format(
+                        ctx.voice_state.MAX_PER_REQUESTER))
+                await ctx.send('Added {} into the queue'.format(str(track)))
+
+    @commands.command(name='search')
+    async def _search(self, ctx: commands.Context, *, search: str):
+        """Look through songs played before, then nia play the link you want"""
+        results = YTDLSource.search_index.search(search, limit=5)
+        if not results:
+            return await ctx.send('I haven\'t played anything like `{}` yet'.format(
+                discord.utils.escape_markdown(search)))
+
+        lines = []
+        for index, (_, _, url, title, uploader, duration) in enumerate(results, start=1):
+            if len(title) > QueuePages.TITLE_LIMIT:
+                title = title[:QueuePages.TITLE_LIMIT - 1] + '…'
+            title = discord.utils.escape_markdown(title).replace('[', '\\[').replace(']', '\\]')
+            by = ' by {}'.format(discord.utils.escape_markdown(uploader)) if uploader else ''
+            lines.append('`{}.` [**{}**]({}){} {}'.format(
+                index, title, url, by, YTDLSource.parse_duration(duration) or ''))
+        embed = discord.Embed(title='Songs I know like that', description='\n'.join(lines))
+        await ctx.send(embed=embed)
 
-                await ctx.voice_state.songs.put(song)
-                await ctx.send('Added {} into the queue'.format(str(source)))
+    @commands.command(name='playlist')
+    async def _playlist(self, ctx: commands.Context, *, url: str):
+        """Queue a whole playlist. Songs are looked up just before they play"""
+        if not ctx.voice_state.voice:
+            await ctx.invoke(self._join)
+
+        queued = 0
+        async with ctx.typing():
+            try:
+                async for batch in YTDLSource.iter_playlist(url, loop=self.bot.loop, guild_id=ctx.guild.id):
+                    full = False
+                    for track in batch:
+                        if not ctx.voice_state.enqueue(Song(track, ctx.author, ctx.channel)):
+                            full = True
+                            break
+                        queued += 1
+                    ctx.voice_state.resolve_ahead()
+                    if full:
+                        await ctx.send('You can only have {} songs in the queue, so the rest were left out'.format(
+                            ctx.voice_state.MAX_PER_REQUESTER))
+                        break
+            except YTDLError as e:
+                await ctx.send('Opps.. An internal error occurred while doing that: {}'.format(str(e)))
+
+        if queued:
+            await ctx.send('Added {} tracks into the queue'.format(queued))
 
     @ _join.before_invoke
     @ _play.before_invoke
+    @ _playlist.before_invoke
     async def ensure_voice_state(self, ctx: commands.Context):
         if not ctx.author.voice or not ctx.author.voice.channel:
             raise commands.CommandError(
@@ -579,13 +3716,34 @@ class Music(commands.Cog):
                     'Hey, I\'m already in a voice channel...')
 
 
-bot = commands.Bot(command_prefix='nia ',
-                   description='Yet another musicbot waiting to get a seize and desist letter from Google or Youtube')
-bot.add_cog(Music(bot))
+def main():
+    token = os.environ.get('NIA_TOKEN')
+    if not token:
+        print("[ERROR] SET NIA_TOKEN TO THE BOT TOKEN")
+        sys.exit(1)
+
+    # launcher.py starts one process per shard and passes these in.
+    shard = {}
+    if 'NIA_SHARD_ID' in os.environ:
+        shard = dict(shard_id=int(os.environ['NIA_SHARD_ID']),
+                     shard_count=int(os.environ['NIA_SHARD_COUNT']))
+        YTDLSource.audio_cache.rescan = AudioCache.SHARED_RESCAN
+        YTDLSource.throughput.probing = shard['shard_id'] == 0
+        YTDLSource.throughput.shared = 'speedtest.json'
+    if 'NIA_METRICS_PORT' in os.environ:
+        Music.METRICS_PORT = int(os.environ['NIA_METRICS_PORT'])
+
+    bot = commands.Bot(command_prefix='nia ',
+                       description='Yet another musicbot waiting to get a seize and desist letter from Google or Youtube',
+                       **shard)
+    bot.add_cog(Music(bot))
+
+    @ bot.event
+    async def on_ready():
+        print('Logged in as:\n{0.user.name}\n{0.user.id}'.format(bot))
 
+    bot.run(token)
 
-@ bot.event
-async def on_ready():
-    print('Logged in as:\n{0.user.name}\n{0.user.id}'.format(bot))
 
-bot.run("YOUR-DISCORD-TOKEN-HERE")
+if __name__ == '__main__':
+    main()
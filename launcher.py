@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import os
+import re
+import signal
+import sys
+import time
+
+# Runs init.py once per Discord shard, restarts shards that crash and serves
+# the metrics of all of them from one port, each sample tagged with its shard.
+#
+#   python launcher.py --shards 4
+#
+# Shard i serves its own metrics on METRICS_PORT + 1 + i.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9464
+# A shard that crashes is restarted after RESTART_DELAY seconds, doubling
+# up to MAX_RESTART_DELAY while it keeps crashing within STABLE_AFTER.
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+STABLE_AFTER = 60
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (.*)$')
+
+
+class Shard:
+    def __init__(self, shard_id: int, shard_count: int):
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.metrics_port = METRICS_PORT + 1 + shard_id
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        self.delay = RESTART_DELAY
+        self.stopping = False
+
+    async def start(self):
+        # Unbuffered, so log lines arrive as they're printed and none are lost in a crash.
+        env = dict(os.environ,
+                   PYTHONUNBUFFERED='1',
+                   NIA_SHARD_ID=str(self.shard_id),
+                   NIA_SHARD_COUNT=str(self.shard_count),
+                   NIA_METRICS_PORT=str(self.metrics_port))
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(HERE, 'init.py'), cwd=HERE, env=env,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        self.started_at = time.monotonic()
+        print("[INFO] STARTED SHARD {} (PID {})".format(self.shard_id, self.process.pid))
+
+    async def run(self):
+        # Returns once the shard exits cleanly, i.e. `nia shutdown`.
+        while True:
+            await self.start()
+            async for line in self.process.stdout:
+                print('[SHARD {}] {}'.format(self.shard_id, line.decode(errors='replace').rstrip()))
+
+            code = await self.process.wait()
+            if code == 0 or self.stopping:
+                print("[INFO] SHARD {} STOPPED".format(self.shard_id))
+                return
+
+            if time.monotonic() - self.started_at > STABLE_AFTER:
+                self.delay = RESTART_DELAY
+            print("[ERROR] SHARD {} EXITED WITH {}, RESTARTING IN {}S".format(self.shard_id, code, self.delay))
+            self.restarts += 1
+            await asyncio.sleep(self.delay)
+            self.delay = min(self.delay * 2, MAX_RESTART_DELAY)
+            if self.stopping:
+                return
+
+    @property
+    def up(self):
+        return self.process is not None and self.process.returncode is None
+
+    def stop(self):
+        self.stopping = True
+        if self.up:
+            self.process.terminate()
+
+    async def scrape(self):
+        reader, writer = await asyncio.open_connection(METRICS_HOST, self.metrics_port)
+        try:
+            writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+        return response.partition(b'\r\n\r\n')[2].decode()
+
+
+class Supervisor:
+    def __init__(self, shard_count: int):
+        self.shards = [Shard(shard_id, shard_count) for shard_id in range(shard_count)]
+
+    async def metrics(self):
+        results = await asyncio.gather(
+            *(asyncio.wait_for(shard.scrape(), 5) for shard in self.shards), return_exceptions=True)
+
+        seen = set()
+        lines = [
+            '# HELP nia_shard_up Whether the shard process is running.',
+            '# TYPE nia_shard_up gauge',
+        ]
+        lines += ['nia_shard_up{{shard="{}"}} {}'.format(shard.shard_id, int(shard.up)) for shard in self.shards]
+        lines += [
+            '# HELP nia_shard_restarts_total Times the shard was restarted after crashing.',
+            '# TYPE nia_shard_restarts_total counter',
+        ]
+        lines += ['nia_shard_restarts_total{{shard="{}"}} {}'.format(shard.shard_id, shard.restarts)
+                  for shard in self.shards]
+
+        for shard, text in zip(self.shards, results):
+            if isinstance(text, BaseException):
+                continue
+            for line in text.splitlines():
+                if line.startswith('#'):
+                    if line not in seen:
+                        seen.add(line)
+                        lines.append(line)
+                    continue
+
+                match = SAMPLE.match(line)
+                if match is None:
+                    continue
+                name, labels, value = match.groups()
+                labels = 'shard="{}"'.format(shard.shard_id) + (',' + labels if labels else '')
+                lines.append('{}{{{}}} {}'.format(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            body = (await self.metrics()).encode()
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        server = await asyncio.start_server(self.handle, METRICS_HOST, METRICS_PORT)
+        print("[INFO] SERVING SHARD METRICS ON {}:{}".format(METRICS_HOST, METRICS_PORT))
+
+        # One shard stopping cleanly means `nia shutdown`, so take the rest down too.
+        runs = [loop.create_task(shard.run()) for shard in self.shards]
+        try:
+            await asyncio.wait(runs, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.stop()
+            for run in runs:
+                run.cancel()
+            await asyncio.gather(*runs, return_exceptions=True)
+            await asyncio.gather(*(shard.process.wait() for shard in self.shards if shard.process))
+            server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run Nia as one process per Discord shard.')
+    parser.add_argument('--shards', type=int, default=os.cpu_count() or 1,
+                        help='number of shard processes (default: one per core)')
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(Supervisor(args.shards).run())
+
+
+if __name__ == '__main__':
+    main()
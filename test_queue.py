@@ -0,0 +1,160 @@
+import asyncio
+import random
+import shutil
+import tempfile
+import unittest
+
+from fakes import FakeChannel, FakeGuild, FakeMember
+from init import QueueJournal, Song, SongQueue, Track
+
+# Drives SongQueue through random operations next to a plain list and checks
+# that the treap underneath, its per-requester indexes and the journal replay
+# all agree with the list.
+#
+#   python -m unittest test_queue
+
+GUILD = FakeGuild(1)
+CHANNEL = FakeChannel(GUILD, 11)
+MEMBERS = [FakeMember(member_id) for member_id in range(100, 105)]
+
+
+def fair_index(model: list, requester_id: int):
+    # What SongTree.fair_index works out, the slow way.
+    positions = {}
+    for index, song in enumerate(model):
+        positions.setdefault(song.requester.id, []).append(index)
+
+    mine = positions.get(requester_id, [])
+    index = len(model)
+    for key, indexes in positions.items():
+        if key != requester_id and len(indexes) > len(mine) + 1:
+            index = min(index, indexes[len(mine) + 1])
+    if mine:
+        index = max(index, mine[-1] + 1)
+    return index
+
+
+class QueueFuzz:
+    def __init__(self, rng: random.Random, record=None):
+        self.rng = rng
+        self.model = []
+        self.ops = []
+        self.record = record
+        self.queue = SongQueue(record=self._record)
+        self.made = 0
+
+    def _record(self, op: dict):
+        self.ops.append(op)
+        if self.record is not None:
+            self.record(op)
+
+    def song(self):
+        self.made += 1
+        track = Track(id=str(self.made), title='Song {}'.format(self.made),
+                      url='https://fake.invalid/watch?v={}'.format(self.made),
+                      duration=self.rng.randint(0, 600))
+        return Song(track, self.rng.choice(MEMBERS), CHANNEL)
+
+    def step(self):
+        rng, queue, model = self.rng, self.queue, self.model
+        choice = rng.random()
+        if choice < 0.3 or not model:
+            song = self.song()
+            queue.put_nowait(song)
+            model.append(song)
+        elif choice < 0.4:
+            song, index = self.song(), rng.randint(-2, len(model) + 2)
+            queue.insert(index, song)
+            model.insert(min(max(index, 0), len(model)), song)
+        elif choice < 0.55:
+            song = self.song()
+            index = fair_index(model, song.requester.id)
+            queue.put_fair(song)
+            model.insert(index, song)
+        elif choice < 0.65:
+            assert queue.get_nowait() is model.pop(0)
+        elif choice < 0.75:
+            source, destination = rng.randrange(len(model)), rng.randrange(len(model))
+            queue.move(source, destination)
+            model.insert(destination, model.pop(source))
+        elif choice < 0.85:
+            index = rng.randrange(len(model))
+            queue.remove(index)
+            del model[index]
+        elif choice < 0.9:
+            queue.shuffle()
+            random.Random(self.ops[-1]['seed']).shuffle(model)
+        elif choice < 0.98:
+            # A playlist entry resolving to a track with a different length.
+            song = rng.choice(model)
+            song.track = Track(id=song.track.id, title=song.track.title, url=song.track.url,
+                               duration=rng.randint(0, 600))
+            queue.refresh(song)
+        else:
+            queue.clear()
+            model.clear()
+
+
+class SongQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def check(self, fuzz: QueueFuzz):
+        queue, model, rng = fuzz.queue, fuzz.model, fuzz.rng
+        self.assertEqual(list(queue), model)
+        self.assertEqual(len(queue), len(model))
+        self.assertEqual(queue.duration, sum(song.track.duration for song in model))
+        if model:
+            index = rng.randrange(len(model))
+            self.assertIs(queue[index], model[index])
+            self.assertIs(queue[-1], model[-1])
+            self.assertEqual(queue.starts_in(index), sum(song.track.duration for song in model[:index]))
+            start = rng.randint(0, len(model))
+            stop = rng.randint(start, len(model) + 3)
+            self.assertEqual(queue[start:stop], model[start:stop])
+
+        for member in MEMBERS:
+            theirs = [song for song in model if song.requester is member]
+            self.assertEqual(queue.count(member.id), len(theirs))
+            self.assertEqual(queue.songs_of(member.id), theirs)
+
+    def test_matches_a_list(self):
+        for seed in range(20):
+            fuzz = QueueFuzz(random.Random(seed))
+            for _ in range(500):
+                fuzz.step()
+                self.check(fuzz)
+
+    def test_journal_replay(self):
+        directory = tempfile.mkdtemp(prefix='nia-test-')
+        self.addCleanup(shutil.rmtree, directory)
+
+        for seed in range(10):
+            guild_id = 1000 + seed
+            journal = QueueJournal(directory)
+            # Compacted often, so replays start from a snapshot most of the time.
+            journal.COMPACT_EVERY = 7
+
+            def record(op: dict):
+                if journal.record(guild_id, op):
+                    journal.snapshot(guild_id, {'voice': None, 'current': None, 'position': 0,
+                                                'songs': [song.to_dict() for song in fuzz.queue]})
+
+            fuzz = QueueFuzz(random.Random(seed), record=record)
+            for _ in range(300):
+                fuzz.step()
+            journal.close()
+
+            # Resolved tracks aren't journaled, so only which song and whose.
+            state = QueueJournal(directory)._load(guild_id)
+            self.assertEqual([(data['track']['url'], data['requester']) for data in state['songs']],
+                             [(song.track.url, song.requester.id) for song in fuzz.model])
+
+
+if __name__ == '__main__':
+    unittest.main()